@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+import Orion
+from Entity_cache import entity_cache
+from Process import PerProcess
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEvaluator:
+    """
+    Evaluates many rules at once. The values of every entity of the rules of a service and servicepath are asked to
+    Orion in bulk before evaluating them, and the rules are evaluated by a pool of threads kept between runs.
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = PerProcess(lambda: ThreadPoolExecutor(max(self.workers, 1), thread_name_prefix='cepheid-batch'))
+
+    @staticmethod
+    def _prefetch(rules: list):
+        """
+        Gets the values of every attribute of some rules of the same service and servicepath.
+        :return: The context, in the format {entity_id: {attr: value}}.
+        """
+        entities, attrs = {}, set()
+        for rule in rules:
+            for entity_id, entity in rule.get_entities().items():
+                entities[entity_id] = entity['type']
+                attrs.update(entity['attrs'])
+        headers = rules[0].headers
+        context = Orion.query(entities, attrs, headers)
+        entity_cache.update(headers['Fiware-Service'], headers['Fiware-ServicePath'], context)
+        return context
+
+    def run(self, rules: dict, action):
+        """
+        :param rules: Dict in the format {rule id: Rule}.
+        :param action: Called with (rule id, rule, context) for each rule, i.e. to evaluate or execute it. The
+        attributes not in the context are looked up as in Rule.eval.
+        :return: Stats of the run: rules, results and throughput.
+        """
+        start = time.monotonic()
+        tenants = {}
+        for rule_id, rule in rules.items():
+            tenants.setdefault((rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath']), {})[rule_id] = rule
+
+        results = {True: 0, False: 0, None: 0}
+        errors = 0
+        pool = self._pool.get()
+        contexts = {tenant: pool.submit(self._prefetch, list(group.values())) for tenant, group in tenants.items()}
+        futures = []
+        for tenant, group in tenants.items():
+            try:
+                context = contexts[tenant].result()
+            except Exception as e:  # Each rule will ask for its own values
+                logger.warning(f'The entities of {tenant[0]}{tenant[1]} cannot be prefetched: {e}')
+                context = {}
+            futures.extend(
+                (rule_id, pool.submit(action, rule_id, rule, context)) for rule_id, rule in group.items()
+            )
+        for rule_id, future in futures:
+            try:
+                result = future.result()
+                results[None if result is None else bool(result)] += 1
+                logger.debug(f'{rules[rule_id].rule} --> {result}')
+            except Exception as e:
+                errors += 1
+                logger.error(f'The rule {rule_id} cannot be evaluated: {e}')
+
+        seconds = time.monotonic() - start
+        return {
+            'rules': len(rules), 'tenants': len(tenants), 'true': results[True], 'false': results[False],
+            'skipped': results[None], 'errors': errors, 'seconds': seconds,
+            'rules_per_second': len(rules) / seconds if seconds else None
+        }
@@ -0,0 +1,38 @@
+"""
+Measures the time to build the rule compiler (Lexer and Parser) in a fresh process, as a worker does when it spawns.
+The imports are not measured.
+Run it from the app directory: python Benchmarks/startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import time
+from Compiler import Lexer, Parser
+start = time.perf_counter()
+Lexer(), Parser()
+print(time.perf_counter() - start)
+"""
+
+
+def spawn(cache_id, cache_dir):
+    env = dict(os.environ, CEP_PARSER_CACHE_ID=cache_id, XDG_CACHE_HOME=cache_dir)
+    out = subprocess.run([sys.executable, '-c', CHILD], cwd=APP_DIR, env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout)
+
+
+def measure(name, cache_id, cache_dir):
+    times = sorted(spawn(cache_id, cache_dir) for _ in range(RUNS))
+    print(f'{name:<16} median: {times[len(times) // 2] * 1000:8.2f} ms   min: {times[0] * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as cache_dir:
+        measure('Without cache', '', cache_dir)
+        spawn('benchmark', cache_dir)  # Writes the tables
+        measure('Cached tables', 'benchmark', cache_dir)
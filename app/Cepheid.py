@@ -1,12 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
+import os
+import queue
+import socket
+import time
 
+from bson import ObjectId
 from flask import request, Response
+from pymongo.errors import DuplicateKeyError
 
+from Batch import BatchEvaluator
+from Commands import command_batcher
+from Compiler import parse_cache
+from Entity_cache import entity_cache, notified_values
 from Rules_db import RulesDB, Rule
-from config import default_service, default_servicepath, CEP_MONGO_HOST
+from Rules_registry import RulesRegistry
+from Scheduler import RuleScheduler
+from Sequences import sequence_stats
+from Subscriptions import SubscriptionManager
+from Windows import window_store
+from Workers import NotificationWorkers
+from config import default_service, default_servicepath, CEP_MONGO_HOST, notify_workers, notify_queue_size, \
+    incremental_eval, bulk_workers, bulk_max_rules, batch_eval_workers, scheduler_tick, scheduler_sync, scheduler_lease
 
 logger = logging.getLogger(__name__)
+
 ch = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 
@@ -17,6 +36,16 @@ logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
 
+def stream_json(items):
+    """
+    Serializes a JSON array one item at a time, to send it in a streamed response.
+    """
+    yield '['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item)
+    yield ']'
+
+
 class Cepheid:
     instance = None
     rules = None
@@ -26,15 +55,133 @@ class Cepheid:
             logger.info('Connecting to database...')
             cls.rules_db = RulesDB()
             logger.info(f'Conected to MongoDB (Host: {CEP_MONGO_HOST})')
-            cls.instance = object.__new__(cls)
+            cls.subscriptions = SubscriptionManager()
+            instance = object.__new__(cls)  # The scheduler runs its rules with it, once loaded
+            cls.scheduler = RuleScheduler(
+                scheduler_tick, instance._ejecutar_periodicas, sync=instance._sincronizar_periodicas,
+                sync_every=scheduler_sync, is_leader=instance._es_lider
+            )
+            cls.registry = RulesRegistry(cls.rules_db, cls.subscriptions, cls.scheduler)
+            logger.info(f'Loaded {cls.registry.load()} rules.')
+            cls.workers = NotificationWorkers(notify_workers, notify_queue_size)
+            cls.batch = BatchEvaluator(batch_eval_workers)
+            cls.scheduler.start_after_fork()  # Not in the uWSGI master, only in its workers
+            cls.instance = instance
         return cls.instance
 
     def ejecutar_reglas(self, evaluate_only=False):
-        rules = [r for svc, svcP in self.rules_db.get_services() for r in self.rules_db.get_all(svc, svcP)]
+        """
+        Evaluates, or executes, every rule of the database at once.
+        :return: Stats of the run.
+        """
+        rules = {}
+        for doc in self.rules_db.iter_all():
+            rule_id = doc.pop('id')
+            try:  # The rules in memory keep the state of their last executions
+                if rule_id in self.registry:
+                    rules[rule_id] = self.registry.find(rule_id, doc['service'], doc['servicepath'])
+                else:
+                    rules[rule_id] = Rule.from_dict(doc, trusted=True)
+            except Exception as e:
+                logger.error(f'The rule {rule_id} cannot be loaded: {e}')
+
+        to_do = (lambda rule_id, rule, context: rule.eval(context)) if evaluate_only else self._ejecutar
+        the_stats = self.batch.run(rules, to_do)
+        logger.info(f'{the_stats["rules"]} rules evaluated in {the_stats["seconds"]:.2f}s: {json.dumps(the_stats)}')
+        return the_stats
+
+    def _ejecutar_periodicas(self, rule_ids):
+        """
+        Executes the periodic rules due, as a batch: the entities of each service and servicepath are asked at once.
+        """
+        self.batch.run(self.registry.rules(rule_ids), self._ejecutar)
+
+    def _sincronizar_periodicas(self):
+        """
+        Schedules the periodic rules inserted by other workers, and stops the ones deleted by them.
+        """
+        stored = set()
+        for rule_id, service, servicepath in self.rules_db.iter_periodic():
+            stored.add(rule_id)
+            if rule_id not in self.registry:
+                try:
+                    self.registry.find(rule_id, service, servicepath)
+                except Exception as e:
+                    logger.error(f'The rule {rule_id} cannot be loaded: {e}')
+        for rule_id in set(self.scheduler.scheduled()) - stored:
+            self.registry.remove(rule_id)
+
+    _lease = (None, 0)  # (pid, time.monotonic() until the lease is held)
+
+    def _es_lider(self):
+        """
+        Only one worker, the one with the lease, runs the periodic rules. It is renewed when half of it has passed.
+        """
+        now = time.monotonic()
+        pid, until = self._lease
+        if pid == os.getpid() and now < until - scheduler_lease / 2:
+            return True
+        if self.rules_db.acquire_lease('scheduler', f'{socket.gethostname()}:{os.getpid()}', scheduler_lease):
+            type(self)._lease = (os.getpid(), now + scheduler_lease)
+            return True
+        return False
+
+    def _ejecutar(self, rule_id, rule, context, memo=None):
+        """
+        Executes a rule. The changes of the result of the on_change rules are persisted, and the command is only sent by
+        the first worker that persists it.
+        :param memo: Results of the comparisons shared between the rules of the same notification.
+        """
+        return rule.execute(context, checkpoint=lambda result: self.rules_db.save_state(rule_id, result), memo=memo)
+
+    @staticmethod
+    def _build_rule(item, service, servicepath):
+        if isinstance(item, Exception):  # Not even valid JSON
+            raise item
+        if not isinstance(item, dict):
+            raise TypeError('Each rule must be a JSON object.')
+        return Rule.from_dict({**item, 'service': service, 'servicepath': servicepath})
 
-        to_do = Rule.eval if evaluate_only else Rule.execute
-        for r in rules:
-            logger.info(f'{r.rule} --> {to_do(r)}')
+    def _insert_bulk(self, items, service: str, servicepath: str):
+        """
+        Inserts several rules. They are validated, and then subscribed, in parallel, and stored with a single insert.
+        :param items: The rules, as POST /rules receives them, or the exception raised reading them.
+        :return: List with the result of each rule: its status code and its id or the error.
+        """
+        results = [None] * len(items)
+        with ThreadPoolExecutor(bulk_workers) as pool:
+            futures = [pool.submit(self._build_rule, item, service, servicepath) for item in items]
+            rules = {}
+            for i, future in enumerate(futures):
+                try:
+                    rules[i] = future.result()
+                except Exception as e:
+                    results[i] = {'status': 400, 'error': 'ParseError', 'description': str(e)}
+
+            subscribing = {}
+            for (i, rule), rule_id in zip(rules.items(), self.rules_db.insert_many(list(rules.values()))):
+                if rule_id is None:
+                    results[i] = {
+                        'status': 409, 'error': 'Already Exists',
+                        'description': 'The rule you are trying to insert already exitsts in the database.'
+                    }
+                else:  # Shares the subscriptions of its entities with the other rules
+                    subscribing[i] = (rule_id, rule, pool.submit(self.subscriptions.attach, rule_id, rule))
+
+            for i, (rule_id, rule, future) in subscribing.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f'Rule cannot be subscribed: {e}')
+                    self.subscriptions.detach(rule_id, service, servicepath)
+                    self.rules_db.delete_by_id(rule_id, service, servicepath)
+                    results[i] = {
+                        'status': 500, 'error': 'UnknownError', 'description': f'The rule cannot be subscribed: {e}'
+                    }
+                else:
+                    self.registry.add(rule_id, rule)
+                    results[i] = {'status': 201, 'id': rule_id}
+        return results
 
     def setup_notifiaciones(self, app):
         @app.route('/notify', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
@@ -44,8 +191,34 @@ class Cepheid:
             if request.data and 'subscriptionId' in request.json:
                 datos = request.json
                 logger.info(f'Notification from a Subscription received. Subs. Id: {datos["subscriptionId"]}')
-                rule = self.rules_db.find_by_subscription_id(datos['subscriptionId'], service, servicePath)
-                rule.execute()
+                rules = self.registry.get(service, servicePath, datos['subscriptionId'])
+                if rules is None:
+                    logger.error(f'No rule for the subscription {datos["subscriptionId"]}.')
+                    return Response(status=404)
+                if not rules:  # Out of their dates or schedule
+                    return Response(status=200)
+                context = Rule.build_context(datos.get('data', []))
+                modified = Rule.build_modified(datos.get('data', []))
+                # Compared with the previous notifications, not with the values read from Orion
+                changed = notified_values.changes(service, servicePath, context, modified)
+                if incremental_eval:  # Only the rules whose inputs have changed
+                    dependents = self.registry.dependents(service, servicePath, changed)
+                    rules = {rule_id: rule for rule_id, rule in rules.items() if rule_id in dependents}
+
+                def accepted():  # Stored only if processed, so a retry is not taken as already notified
+                    notified_values.commit(service, servicePath, context, modified)
+                    entity_cache.update(service, servicePath, context)
+                    window_store.feed(service, servicePath, context, changed)
+
+                memo = {}  # Each comparison shared by several rules is evaluated once per notification
+                try:  # The notifications of the same rule are processed in order. Every rule gets it, or none
+                    self.workers.submit_all([
+                        (rule_id, lambda r_id=rule_id, r=rule: self._ejecutar(r_id, r, context, memo))
+                        for rule_id, rule in rules.items()
+                    ], accepted)
+                except queue.Full:
+                    logger.warning(f'Too many notifications waiting. Subs. Id: {datos["subscriptionId"]}')
+                    return Response(status=503, headers={'Retry-After': '1'})
                 return Response(status=200)
             elif request.data:
                 logger.error(f'No subscriptionId in the request. {json.dumps(request.data, indent=4)}')
@@ -53,6 +226,18 @@ class Cepheid:
                 logger.error(f'No data in the request.')
             return Response(status=404)
 
+    def setup_stats(self, app):
+        @app.route('/stats', methods=['GET'])
+        def stats():
+            the_stats = {
+                'rules': len(self.registry), 'activity': self.registry.activity_stats(),
+                'predicates': self.registry.predicate_stats(),
+                'cache': entity_cache.stats(), 'workers': self.workers.stats(), 'commands': command_batcher.stats(),
+                'windows': window_store.stats(), 'sequences': sequence_stats(), 'parse_cache': parse_cache.stats(),
+                'scheduler': self.scheduler.stats()
+            }
+            return Response(json.dumps(the_stats), status=200, content_type='application/json')
+
     def setup_crud(self, app):
         @app.route('/rules', methods=['POST'])
         def insert_rules():
@@ -81,24 +266,30 @@ class Cepheid:
                 logger.error(f'Error: {e}')
                 err = {"error": "ParseError", "description": str(e)}
                 return Response(json.dumps(err), status=400, content_type='application/json')
-            if r not in self.rules_db:
-
-                r.subscribe()
+            try:  # The same rule cannot be inserted twice (unique hash of its content)
                 rule_id = self.rules_db.insert(r)
-                if rule_id is None:
-                    r.unsubscribe()
-                    logger.info(f'Rule cannot be inserted: {json.dumps(r.to_dict(), indent=4)}')
-                    err = '{"error": "UnknownError", "description": "Something happened while inserting the rule"}'
-                    return Response(json.dumps(err), status=500, content_type='application/json')
-                logger.info(f'Rule inserted: {json.dumps(r.to_dict(), indent=4)}')
-                return Response(status=200, headers={'Location': f'/rules/{rule_id}'})
-            else:
+            except DuplicateKeyError:
                 logger.warning(f'This rule already exists. Rule: {json.dumps(r.to_dict(), indent=4)}')
                 err_msg = {
                     "error": "Already Exists",
                     "description": "The rule you are trying to insert already exitsts in the database."
                 }
                 return Response(json.dumps(err_msg), status=409, headers={"Content-Type": "application/json"})
+            if rule_id is None:
+                logger.info(f'Rule cannot be inserted: {json.dumps(r.to_dict(), indent=4)}')
+                err = '{"error": "UnknownError", "description": "Something happened while inserting the rule"}'
+                return Response(json.dumps(err), status=500, content_type='application/json')
+            try:  # Shares the subscriptions of its entities with the other rules
+                self.subscriptions.attach(rule_id, r)
+            except Exception as e:
+                logger.error(f'Rule cannot be subscribed: {e}')
+                self.subscriptions.detach(rule_id, r.headers['Fiware-Service'], r.headers['Fiware-ServicePath'])
+                self.rules_db.delete_by_id(rule_id, r.headers['Fiware-Service'], r.headers['Fiware-ServicePath'])
+                err = {"error": "UnknownError", "description": f"The rule cannot be subscribed: {e}"}
+                return Response(json.dumps(err), status=500, content_type='application/json')
+            self.registry.add(rule_id, r)
+            logger.info(f'Rule inserted: {json.dumps(r.to_dict(), indent=4)}')
+            return Response(status=200, headers={'Location': f'/rules/{rule_id}'})
 
         @app.route('/rules', methods=['GET'])
         @app.route('/rules/<rule_id>', methods=['GET'])
@@ -106,13 +297,32 @@ class Cepheid:
             service = request.headers.get('Fiware-Service', default_service)
             servicepath = request.headers.get('Fiware-ServicePath', default_servicepath)
 
-            if rule_id is None:  # Return all the rules
+            if rule_id is None and 'entity' in request.args and 'attr' in request.args:  # Rules depending on an attr
+                entity_id, attr = request.args['entity'], request.args['attr']
+                logger.info(f'Returning the Rules that depend on {entity_id}.{attr}.')
+                # From the database, with the ones inserted by other workers
+                rules = self.rules_db.iter_by_attribute(entity_id, attr, service, servicepath)
+                return Response(stream_json(rules), status=200, content_type='application/json')
+            elif rule_id is None:  # Return all the rules, a page at a time if asked
+                try:
+                    limit, offset = int(request.args.get('limit', 0)), int(request.args.get('offset', 0))
+                    if limit < 0 or offset < 0:
+                        raise ValueError('limit and offset must be positive integers.')
+                    after = request.args.get('after')
+                    if after is not None and not ObjectId.is_valid(after):
+                        raise ValueError(f'"{after}" is not a rule id.')
+                except ValueError as e:
+                    err = {"error": "BadRequest", "description": str(e)}
+                    return Response(json.dumps(err), status=400, content_type='application/json')
+                fields = [field for field in request.args.get('fields', '').split(',') if field]
                 logger.info('Returning all the Rules.')
-                return Response(
-                    json.dumps(self.rules_db.get_all(service, servicepath, in_json=True)),
-                    status=200, content_type='application/json'
-                )
+                headers = {}
+                if 'count' in request.args.get('options', '').split(','):
+                    headers['Fiware-Total-Count'] = str(self.rules_db.count(service, servicepath))
+                rules = self.rules_db.iter_rules(service, servicepath, limit, offset, after, fields)
+                return Response(stream_json(rules), status=200, headers=headers, content_type='application/json')
             else:
+                # With the last_result stored, the one of this worker can be out of date
                 rule = self.rules_db.find_by_id(rule_id, service, servicepath, in_json=True)
                 if rule:
                     logger.info(f'Returning the rule with id: {rule_id}.')
@@ -131,6 +341,8 @@ class Cepheid:
 
             result = self.rules_db.delete_by_id(rule_id, service, servicepath)
             if result:
+                self.subscriptions.detach(rule_id, service, servicepath)
+                self.registry.remove(rule_id)
                 logger.info(f'Deleting the rule with id: {rule_id}.')
                 return Response(status=204, content_type='application/json')
             else:
@@ -139,3 +351,60 @@ class Cepheid:
                     "error": "NotFound", "description": "The requested rule has not been found. Check id."
                 }
                 return Response(json.dumps(err_not_found), status=404, content_type='application/json')
+
+        @app.route('/rules/<rule_id>/explain', methods=['GET'])
+        def explain_rule(rule_id):
+            service = request.headers.get('Fiware-Service', default_service)
+            servicepath = request.headers.get('Fiware-ServicePath', default_servicepath)
+
+            rule = self.registry.find(rule_id, service, servicepath)
+            if rule is None or (rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath']) != \
+               (service, servicepath):
+                logger.warning(f'No rule with id {rule_id}.')
+                err_not_found = {
+                    "error": "NotFound", "description": "The requested rule has not been found. Check id."
+                }
+                return Response(json.dumps(err_not_found), status=404, content_type='application/json')
+            logger.info(f'Returning the plan of the rule with id: {rule_id}.')
+            return Response(json.dumps({'id': rule_id, **rule.explain()}), status=200, content_type='application/json')
+
+        @app.route('/rules/bulk', methods=['POST'])
+        def insert_bulk():
+            service = request.headers.get('Fiware-Service', default_service)
+            servicepath = request.headers.get('Fiware-ServicePath', default_servicepath)
+
+            if request.mimetype == 'application/x-ndjson':  # A rule per line
+                items = []
+                for line in request.get_data(as_text=True).splitlines():
+                    if line.strip():
+                        try:
+                            items.append(json.loads(line))
+                        except ValueError as e:
+                            items.append(e)
+            elif request.is_json and isinstance(request.get_json(silent=True), list):
+                items = request.json
+            else:
+                logger.error('Not a json array or ndjson in the content.')
+                err = {"error": "UnsupportedMediaType", "description": "Content must be a json array or ndjson"}
+                return Response(json.dumps(err), status=415, content_type='application/json')
+            if len(items) > bulk_max_rules:
+                err = {"error": "RequestEntityTooLarge", "description": f"Max. {bulk_max_rules} rules per request"}
+                return Response(json.dumps(err), status=413, content_type='application/json')
+
+            results = self._insert_bulk(items, service, servicepath)
+            logger.info(f'{sum(r["status"] == 201 for r in results)} of {len(results)} rules inserted in bulk.')
+            return Response(json.dumps(results), status=200, content_type='application/json')
+
+        @app.route('/rules/export', methods=['GET'])
+        def export_rules():
+            service = request.headers.get('Fiware-Service', default_service)
+            servicepath = request.headers.get('Fiware-ServicePath', default_servicepath)
+
+            def lines():  # In the format of POST /rules/bulk, without what is assigned on insert
+                for rule in self.rules_db.iter_rules(service, servicepath):
+                    for field in ['id', 'service', 'servicepath', 'subsId', 'last_result']:
+                        rule.pop(field, None)
+                    yield json.dumps(rule) + '\n'
+
+            logger.info('Exporting all the Rules.')
+            return Response(lines(), status=200, content_type='application/x-ndjson')
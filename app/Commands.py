@@ -0,0 +1,90 @@
+import json
+import logging
+import threading
+import time
+
+import Orion
+from Process import PerProcess, start_thread
+from config import batch_window, batch_max_actions
+
+logger = logging.getLogger(__name__)
+
+
+class CommandBatcher:
+    """
+    Sends the commands of the rules to Orion. The commands received within a window of time are sent together in a
+    single /v2/op/update per service and servicepath, and the identical ones are sent only once.
+    With a window of 0, every command is sent at once.
+    """
+    def __init__(self, window: float, max_actions: int):
+        """
+        :param window: Seconds a command may wait for others.
+        :param max_actions: Max. number of commands of a request. A group is sent as soon as it has them.
+        """
+        self.window = window
+        self.max_actions = max_actions
+        self._groups = {}  # (service, servicepath) -> (deadline, {(entity_id, type, command): entity})
+        self._cond = threading.Condition()
+        self._thread = PerProcess(lambda: start_thread(self._work, 'cepheid-commands'))
+        self.requests = self.actions = self.duplicated = self.errors = 0
+
+    def _post(self, service: str, servicepath: str, entities: list):
+        headers = {
+            'Content-Type': 'application/json', 'Fiware-Service': service, 'Fiware-ServicePath': servicepath
+        }
+        payload = {"actionType": "update", "entities": entities}
+        res = Orion.post('/v2/op/update', headers, data=json.dumps(payload))
+        self.requests += 1
+        if res.status_code != 204:
+            raise ConnectionError(f'Error running the command. Status code: {res.status_code}')
+
+    def _flush(self, service, servicepath, entities):
+        try:
+            self._post(service, servicepath, entities)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f'Error sending {len(entities)} commands to {service}{servicepath}: {e}')
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._groups:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [k for k, (deadline, entities) in self._groups.items()
+                       if deadline <= now or len(entities) >= self.max_actions]
+                if not due:
+                    self._cond.wait(min(deadline for deadline, _ in self._groups.values()) - now)
+                    continue
+                ready = [(k, list(self._groups.pop(k)[1].values())) for k in due]
+            for (service, servicepath), entities in ready:
+                self._flush(service, servicepath, entities)
+
+    def send(self, headers: dict, entity: dict):
+        """
+        Sends a command.
+        :param headers: Headers of the rule (Fiware-Service and Fiware-ServicePath).
+        :param entity: The entity of the update, in the format {"id": id, "type": type, command: {...}}.
+        """
+        service, servicepath = headers['Fiware-Service'], headers['Fiware-ServicePath']
+        self.actions += 1
+        if self.window <= 0:
+            return self._post(service, servicepath, [entity])
+        self._thread.get()
+        key = (entity['id'], entity['type'], *sorted(k for k in entity if k not in ('id', 'type')))
+        with self._cond:
+            _, entities = self._groups.setdefault((service, servicepath), (time.monotonic() + self.window, {}))
+            if entities.pop(key, None) is not None:  # Sent after the others, as the latest one
+                self.duplicated += 1
+            entities[key] = entity
+            if len(entities) == 1 or len(entities) >= self.max_actions:  # New deadline or full group
+                self._cond.notify()
+
+    def stats(self):
+        return {
+            'window': self.window, 'max_actions': self.max_actions, 'actions': self.actions,
+            'duplicated': self.duplicated, 'requests': self.requests, 'errors': self.errors
+        }
+
+
+command_batcher = CommandBatcher(batch_window, batch_max_actions)
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import re
+import threading
+
+from config import parse_cache_size
+
+
+def normalize(rule: str):
+    """
+    Normalizes the spaces of a rule outside its strings, so the same rule written differently has the same text.
+    :param rule: Text of the rule.
+    :return: The normalized text.
+    """
+    parts = re.split(r'("(?:""|[^"])*")', rule.strip())
+    for i in range(0, len(parts), 2):  # The odd parts are strings
+        part = re.sub(r'\s+', ' ', parts[i])
+        parts[i] = re.sub(r'\s*([(),])\s*', r'\1', part)
+    return ''.join(parts)
+
+
+class ParseCache:
+    """
+    Parsed rules, shared by every rule of the process, so each distinct rule is lexed and parsed once. They are keyed
+    by (normalized text, service, servicepath), and when there are more than max_size the least recently used ones
+    are evicted.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._trees = OrderedDict()  # (normalized text, service, servicepath) -> (tree, entities)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(rule: str, service: str, servicepath: str):
+        return normalize(rule), service, servicepath
+
+    def get(self, key):
+        """
+        :return: (tree, entities) of the rule, or None if it is not cached. entities is the result of
+        tree.get_entities(), which must not be modified.
+        """
+        with self._lock:
+            item = self._trees.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._trees.move_to_end(key)
+            return item
+
+    def put(self, key, tree):
+        """
+        Caches a parsed rule.
+        :return: (tree, entities) of the rule.
+        """
+        item = (tree, tree.get_entities())
+        if self.max_size <= 0:
+            return item
+        with self._lock:
+            self._trees[key] = item
+            self._trees.move_to_end(key)
+            while len(self._trees) > self.max_size:
+                self._trees.popitem(last=False)
+                self.evictions += 1
+        return item
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._trees), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / total if total else None, 'evictions': self.evictions
+        }
+
+    def __len__(self):
+        return len(self._trees)
+
+
+parse_cache = ParseCache(parse_cache_size)
@@ -0,0 +1,76 @@
+class CodeGenerator:
+    """
+    Turns a parsed rule into a single python function. The constant parts of the rule are folded and the attributes
+    are reduced to an indexing of the context ({entity_id: {attr: value}}), which must have all of them.
+    """
+    def __init__(self, observe=False, automata=None, shared=frozenset()):
+        """
+        :param observe: If the generated code counts the results of the operands of the logical operators.
+        :param automata: State of the sequences of a previous compilation of the rule, to keep it.
+        :param shared: Normalized text of the comparisons shared with other rules. Their results are kept in the memo
+        of the event, to evaluate them once per event.
+        """
+        self.observing = observe
+        self.shared = shared
+        self.memoized = False
+        self.attributes = {}  # (entity_id, attr_id) -> Attribute
+        self.bindings = {}  # Objects the generated code refers to by name
+        self.automata = {}  # Sequence -> its state in this rule
+        self._previous_automata = automata or {}
+
+    def attribute(self, attribute):
+        self.attributes.setdefault((attribute.entity_id, attribute.attr_id), attribute)
+        return f'ctx[{attribute.entity_id!r}][{attribute.attr_id!r}]'
+
+    def bind(self, obj, prefix='_b'):
+        name = f'{prefix}{len(self.bindings)}'
+        self.bindings[name] = obj
+        return name
+
+    def automaton(self, sequence):
+        if sequence in self._previous_automata:
+            automaton = self._previous_automata[sequence]
+        else:
+            automaton = sequence.automaton()
+        self.automata[sequence] = automaton
+        return self.bind(automaton, '_s')
+
+    def share(self, predicate, source):
+        key = predicate.normalized()
+        if key not in self.shared:
+            return source
+        self.memoized = True
+        return f'(memo[{key!r}] if {key!r} in memo else memo.setdefault({key!r}, {source}))'
+
+    def observe(self, predicate, source):
+        if not self.observing:
+            return source
+        return f'{self.bind(predicate, "_o")}.observe({source})'
+
+    def build(self, tree, name='rule'):
+        body = tree.source(self)
+        memo = '    if memo is None:\n        memo = {}\n' if self.memoized else ''
+        source = f'def {name}(ctx, memo=None):\n{memo}    return {body}\n'
+        namespace = dict(self.bindings)
+        exec(compile(source, f'<{name}>', 'exec'), namespace)
+        function = namespace[name]
+        function.source = source
+        function.attributes = list(self.attributes.values())
+        function.automata = self.automata
+        function.observing = self.observing
+        return function
+
+
+def compile_rule(tree, name='rule', observe=False, automata=None, shared=frozenset()):
+    """
+    Compiles a parsed rule.
+    :param tree: The root of the rule, as returned by the Parser.
+    :param name: Name of the generated function.
+    :param observe: If the generated code counts the results of the operands, to plan a better order later.
+    :param automata: The "automata" of a previous compilation of the rule, to keep the state of its sequences.
+    :param shared: Normalized text of the comparisons whose results are shared with other rules.
+    :return: A function that receives the context (and the memo of the event) and returns the result of the rule.
+    The attributes it needs are in its "attributes" member, the generated code in "source" and the state of its
+    sequences in "automata".
+    """
+    return CodeGenerator(observe, automata, shared).build(tree, name)
@@ -26,6 +26,15 @@ class Lexer:
         # Logical operations
         self.__lexer.add('OR', r'(?i)or')
         self.__lexer.add('AND', r'(?i)and')
+        # Sequences
+        self.__lexer.add('SEQ', r'(?i)seq(?=\s*\()')
+        self.__lexer.add('WITHIN', r'(?i)within(?!\w)')
+        self.__lexer.add('NOT', r'(?i)not(?!\w)')
+        # Window functions
+        for function in ['AVG', 'MAX', 'MIN', 'COUNT', 'RATE']:
+            self.__lexer.add(function, rf'(?i){function}(?=\s*\()')
+        # Durations
+        self.__lexer.add('DURATION', r'\d+(\.\d+)?[smhd](?!\w)')
         # Numbers
         self.__lexer.add('DECIMAL', r'\d+\.\d+')
         self.__lexer.add('INTEGER', r'\d+')
@@ -1,8 +1,17 @@
-import requests
-
 from rply import ParserGenerator
 
-from config import orion_url
+import Orion
+from Compiler.Codegen import CodeGenerator
+from Entity_cache import entity_cache
+from Sequences import SequenceAutomaton
+from Process import require_single_process
+from Windows import parse_duration, window_store
+from config import parser_cache_id
+
+# Estimated cost of getting a value, to evaluate the cheapest operands first
+COST_LITERAL = 0
+COST_LOCAL = 1  # In memory: cached attribute or window function
+COST_REMOTE = 10  # Attribute that may be asked to Orion
 
 
 class Value:
@@ -12,14 +21,26 @@ class Value:
     def get_entities(self):
         return {}
 
+    def is_constant(self):
+        return True
+
+    def cost(self):
+        return COST_LITERAL
+
+    def normalized(self):
+        return repr(self.eval())
+
+    def source(self, generator):
+        return repr(self.eval())
+
 
 class Decimal(Value):
-    def eval(self):
+    def eval(self, context=None):
         return float(self.val)
 
 
 class Integer(Value):
-    def eval(self):
+    def eval(self, context=None):
         return int(self.val)
 
 
@@ -27,41 +48,163 @@ class String(Value):
     def __init__(self, val):
         super(String, self).__init__(val[1:-1])
 
-    def eval(self):
+    def eval(self, context=None):
         return self.val
 
 
 class Attribute:
-    def __init__(self, entity_id, attr, headers):
+    def __init__(self, entity_id, attr, headers, entity_type=None):
+        """
+        :param entity_type: The type of the entity, if it is already known (i.e. the rule was validated before).
+        When it is informed, the existence of the entity and the attribute is not checked in Orion.
+        """
         self.entity_id = entity_id
         self.attr_id = attr
         self.headers = headers
-        entity = requests.get(
-            url=f'{orion_url}/v2/entities/{self.entity_id}?options=keyValues',
-            headers=self.headers
-        ).json()
+        if entity_type is not None:
+            self.type = entity_type
+            return
+        entity = Orion.get(f'/v2/entities/{self.entity_id}?options=keyValues', self.headers).json()
         if 'error' in entity:
             raise ValueError(f'The entity "{self.entity_id}" does not exist.')
         if self.attr_id not in entity:
             raise ValueError(f'The attribute "{self.attr_id}", does not belong to the entity "{self.entity_id}".')
         self.type = entity['type']
 
-    def eval(self):
-        response = requests.get(
-            url=f'{orion_url}/v2/entities/{self.entity_id}?options=values&attrs={self.attr_id}', headers=self.headers
-        )
+    def eval(self, context=None):
+        """
+        Gets the value of the attribute. It is taken from the context if it is there, then from the cache, and
+        otherwise it is asked to Orion.
+        :param context: Dict in the format {entity_id: {attr: value}} (i.e. built from a notification).
+        """
+        if context is not None and self.attr_id in context.get(self.entity_id, {}):
+            return context[self.entity_id][self.attr_id]
+        service, servicepath = self.headers['Fiware-Service'], self.headers['Fiware-ServicePath']
+        cached = entity_cache.lookup(service, servicepath, [(self.entity_id, self.attr_id)])
+        if cached:
+            return cached[self.entity_id][self.attr_id]
+        response = Orion.get(f'/v2/entities/{self.entity_id}?options=values&attrs={self.attr_id}', self.headers)
         assert response.status_code == 200, f'Error retrieving the value of {self.entity_id}.{self.attr_id}.'
-        return response.json()[0]
+        value = response.json()[0]
+        entity_cache.update(service, servicepath, {self.entity_id: {self.attr_id: value}})
+        return value
 
     def get_entities(self):
         return {self.entity_id: {'type': self.type, 'attrs': {self.attr_id}}}
 
+    def is_constant(self):
+        return False
+
+    def cost(self):
+        key = (self.headers['Fiware-Service'], self.headers['Fiware-ServicePath'], self.entity_id, self.attr_id)
+        return COST_LOCAL if key in entity_cache else COST_REMOTE
+
+    def normalized(self):
+        return f'{self.entity_id!r}.{self.attr_id!r}'
+
+    def source(self, generator):
+        return generator.attribute(self)
+
+
+class WindowFunction:
+    """
+    Aggregate of the values notified of an attribute within the last window of time (i.e. AVG(room.temp, 5m)).
+    The aggregate is kept incrementally in the window store, it does not ask Orion. Without samples, it is NaN (0 for
+    COUNT), so every comparison with it is false. The store is in the memory of the process, so they are only allowed
+    when a single process gets every notification.
+    """
+    def __init__(self, function: str, attribute: Attribute, duration: str):
+        require_single_process('Window functions')
+        self.function = function
+        self.attribute = attribute
+        self.window = parse_duration(duration)
+        self.aggregator = window_store.register(
+            attribute.headers['Fiware-Service'], attribute.headers['Fiware-ServicePath'],
+            attribute.entity_id, attribute.attr_id, function, self.window
+        )
+
+    def eval(self, context=None):
+        return self.aggregator.value()
+
+    def get_entities(self):
+        return self.attribute.get_entities()
+
+    def is_constant(self):
+        return False
+
+    def cost(self):
+        return COST_LOCAL
+
+    def normalized(self):
+        return f'{self.function}({self.attribute.normalized()}, {self.window})'
+
+    def source(self, generator):
+        return f'{generator.bind(self.aggregator, "_w")}.value()'
 
-class BinaryOperator:
-    def __init__(self, left, right):
+
+class Predicate:
+    """
+    Boolean node. The results it has when the rule is evaluated are observed to know its selectivity.
+    """
+    evaluations = trues = 0
+
+    def observe(self, result):
+        self.evaluations += 1
+        self.trues += bool(result)
+        return result
+
+    def selectivity(self):
+        """
+        :return: Observed fraction of evaluations in which it is true, or None if it has not been observed.
+        """
+        return self.trues / self.evaluations if self.evaluations else None
+
+    def is_stateful(self):
+        """
+        :return: If it keeps state between evaluations, so it must be evaluated every time.
+        """
+        return False
+
+    def predicates(self):
+        """
+        :return: The comparisons of attributes within the node, the ones whose result can be shared between rules.
+        """
+        return []
+
+    def explain(self):
+        return {'cost': self.cost(), 'selectivity': self.selectivity(), 'evaluations': self.evaluations}
+
+
+class BinaryOperator(Predicate):
+    symbol = None
+
+    def __init__(self, left, right, check=True):
         self.left = left
         self.right = right
 
+    def is_constant(self):
+        return self.left.is_constant() and self.right.is_constant()
+
+    def cost(self):
+        return self.left.cost() + self.right.cost()
+
+    def normalized(self):
+        """
+        :return: Text of the comparison, the same for every rule that has it.
+        """
+        return f'{self.left.normalized()} {self.symbol} {self.right.normalized()}'
+
+    def predicates(self):
+        return [] if self.is_constant() else [self]
+
+    def explain(self):
+        return {'expression': self.source(CodeGenerator()), **super().explain()}
+
+    def source(self, generator):
+        if self.is_constant():
+            return repr(self.eval())
+        return generator.share(self, f'({self.left.source(generator)} {self.symbol} {self.right.source(generator)})')
+
     def get_entities(self):
         left_entities = self.left.get_entities()
         for k, v in self.right.get_entities().items():
@@ -74,54 +217,139 @@ class BinaryOperator:
 
 
 class BinaryNumericOperator(BinaryOperator):
-    def __init__(self, left, right):
-        if not (isinstance(left.eval(), (int, float)) and isinstance(right.eval(), (int, float))):
+    def __init__(self, left, right, check=True):
+        if check and not (isinstance(left.eval(), (int, float)) and isinstance(right.eval(), (int, float))):
             raise TypeError('The types of the Left and Right values must Integer or Floats.')
         super().__init__(left, right)
 
 
 class EqualityOperator(BinaryOperator):
-    def __init__(self, left, right):
-        if not isinstance(l_val := left.eval(), type(r_val := right.eval())) and \
+    def __init__(self, left, right, check=True):
+        if check and not isinstance(l_val := left.eval(), type(r_val := right.eval())) and \
            not (isinstance(l_val, (int, float)) and isinstance(r_val, (int, float))):
             raise TypeError('The types of the Left and Right values must be equal.')
         super().__init__(left, right)
 
 
 class Equal(EqualityOperator):
-    def eval(self):
-        return self.left.eval() == self.right.eval()
+    symbol = '=='
+
+    def eval(self, context=None):
+        return self.left.eval(context) == self.right.eval(context)
 
 
 class Distinct(EqualityOperator):
-    def eval(self):
-        return self.left.eval() != self.right.eval()
+    symbol = '!='
+
+    def eval(self, context=None):
+        return self.left.eval(context) != self.right.eval(context)
 
 
 class Greater(BinaryOperator):
-    def eval(self):
-        return self.left.eval() > self.right.eval()
+    symbol = '>'
+
+    def eval(self, context=None):
+        return self.left.eval(context) > self.right.eval(context)
 
 
 class Lower(BinaryOperator):
-    def eval(self):
-        return self.left.eval() < self.right.eval()
+    symbol = '<'
+
+    def eval(self, context=None):
+        return self.left.eval(context) < self.right.eval(context)
 
 
 class GreaterEq(BinaryNumericOperator):
-    def eval(self):
-        return self.left.eval() >= self.right.eval()
+    symbol = '>='
+
+    def eval(self, context=None):
+        return self.left.eval(context) >= self.right.eval(context)
 
 
 class LowerEq(BinaryNumericOperator):
-    def eval(self):
-        return self.left.eval() <= self.right.eval()
+    symbol = '<='
+
+    def eval(self, context=None):
+        return self.left.eval(context) <= self.right.eval(context)
+
 
+class LogicalOperator(Predicate):
+    keyword = None
+    neutral = None  # Value that does not change the result of the operation
 
-class LogicalOperator:
     def __init__(self, expressions: list):
         self.expressions = expressions
 
+    def is_constant(self):
+        return all(exp.is_constant() for exp in self.expressions)
+
+    def is_stateful(self):
+        return any(exp.is_stateful() for exp in self.expressions)
+
+    def cost(self):
+        return sum(exp.cost() for exp in self.expressions)
+
+    def predicates(self):
+        return [predicate for exp in self.expressions for predicate in exp.predicates()]
+
+    def _rank(self, exp):
+        """
+        Cost of an operand per chance of deciding the result by itself (false for "and", true for "or"). Without
+        observations, the chance is 0.5.
+        """
+        selectivity = exp.selectivity()
+        selectivity = 0.5 if selectivity is None else selectivity
+        decides = 1 - selectivity if self.neutral else selectivity
+        return exp.cost() / max(decides, 0.01)
+
+    def plan(self):
+        """
+        Orders the operands to evaluate first the ones that decide the result at the lowest cost. The stateful
+        operands go first, and are always evaluated.
+        :return: (result, stateful, rest). The result if it is decided by the constant operands (None otherwise), and
+        the not constant operands in the order they are evaluated.
+        """
+        operands = []
+        for exp in self.expressions:
+            if not exp.is_constant():
+                operands.append(exp)
+            elif bool(exp.eval()) != self.neutral:  # Decides the result by itself
+                return not self.neutral, [], []
+        stateful = [exp for exp in operands if exp.is_stateful()]
+        rest = sorted((exp for exp in operands if not exp.is_stateful()), key=self._rank)  # Stable on ties
+        return None, stateful, rest
+
+    def eval(self, context=None):
+        result, stateful, rest = self.plan()
+        if result is not None:
+            return result
+        if any([bool(exp.eval(context)) != self.neutral for exp in stateful]):
+            return not self.neutral
+        if any(bool(exp.eval(context)) != self.neutral for exp in rest):
+            return not self.neutral
+        return self.neutral
+
+    def source(self, generator):
+        result, stateful, rest = self.plan()
+        if result is not None:
+            return repr(result)
+        operands = [generator.observe(exp, exp.source(generator)) for exp in stateful + rest]
+        if len(stateful) > 1:  # Every stateful operand is evaluated before the rest
+            function = 'all' if self.neutral else 'any'
+            operands[:len(stateful)] = [f'{function}(({", ".join(operands[:len(stateful)])},))']
+        if not operands:
+            return repr(self.neutral)
+        return f'({f" {self.keyword} ".join(operands)})'
+
+    def explain(self):
+        result, stateful, rest = self.plan()
+        plan = {'operator': self.keyword, **super().explain()}
+        if result is not None:
+            plan['result'] = result
+        else:
+            plan['operands'] = [exp.explain() for exp in stateful + rest]
+        return plan
+
     def get_entities(self):
         first, *rest = self.expressions
         first_entities = first.get_entities()
@@ -136,19 +364,67 @@ class LogicalOperator:
 
 
 class And(LogicalOperator):
-    def eval(self):
-        return all(exp.eval() for exp in self.expressions)
+    keyword = 'and'
+    neutral = True
 
 
 class Or(LogicalOperator):
-    def eval(self):
-        return any(exp.eval() for exp in self.expressions)
+    keyword = 'or'
+    neutral = False
+
+
+class Sequence(LogicalOperator):
+    """
+    Steps that must happen in order within a window of time (i.e. SEQ(a.door = "open", b.motion = 1, WITHIN 30s)).
+    It is true in the evaluation that completes the sequence. If the last step is negated, it must not happen after the
+    others within the window. The state is kept in an automaton per compiled rule, fed by each evaluation. It is in
+    the memory of the process, so they are only allowed when a single process gets every notification.
+    """
+    keyword = 'seq'
+
+    def __init__(self, expressions: list, within: str, negated: bool = False):
+        require_single_process('Sequences (SEQ)')
+        super().__init__(expressions)
+        self.within = parse_duration(within)
+        self.negated = negated
+        self._automaton = self.automaton()  # State of the interpreted evaluation
+
+    def automaton(self):
+        return SequenceAutomaton(len(self.expressions), self.within, self.negated)
+
+    def is_constant(self):
+        return False
+
+    def is_stateful(self):
+        return True
+
+    def eval(self, context=None):
+        return self._automaton.feed([exp.eval(context) for exp in self.expressions])
+
+    def source(self, generator):
+        conditions = ', '.join(exp.source(generator) for exp in self.expressions)
+        return f'{generator.automaton(self)}.feed(({conditions},))'
+
+    def explain(self):
+        return {
+            'operator': self.keyword, **Predicate.explain(self), 'within': self.within, 'negated': self.negated,
+            'steps': [exp.explain() for exp in self.expressions]
+        }
 
 
 # -------------------------------------------------------------------------------------------------------------------- #
 #                                                       P A R S E R                                                    #
 # -------------------------------------------------------------------------------------------------------------------- #
 
+class ParseState:
+    """
+    Data of a single parse, given to every production.
+    """
+    def __init__(self, headers: dict, entity_types: dict = None):
+        self.headers = headers
+        self.entity_types = entity_types
+
+
 class Parser:
     __ops = {
         'GREATER_EQ': GreaterEq,
@@ -159,23 +435,34 @@ class Parser:
         'LOWER': Lower,
         'OR': Or,
         'AND': And,
+        'SEQ': Sequence,
         'DECIMAL': Decimal,
         'INTEGER': Integer,
-        'STRING': String
+        'STRING': String,
+        'AVG': WindowFunction,
+        'MAX': WindowFunction,
+        'MIN': WindowFunction,
+        'COUNT': WindowFunction,
+        'RATE': WindowFunction
     }
 
     def __init__(self):
+        # The LALR tables are cached on disk by rply, keyed by the hash of the grammar
         self.__pg = ParserGenerator(
-            ['ID', 'L_PAR', 'R_PAR', 'DOT', 'COMMA', *self.__ops.keys()]
+            ['ID', 'L_PAR', 'R_PAR', 'DOT', 'COMMA', 'DURATION', 'WITHIN', 'NOT', *self.__ops.keys()],
+            cache_id=parser_cache_id
         )
 
         self.__setup_parser()
-        self.__parser = self.__pg.build()
-        self.headers = None
+        try:
+            self.__parser = self.__pg.build()
+        except OSError:  # The cache cannot be written, the tables are built without it.
+            self.__pg.cache_id = None
+            self.__parser = self.__pg.build()
 
     def __setup_parser(self):
         @self.__pg.production('comparison : boolean')
-        def comparison(p):
+        def comparison(state, p):
             return p[0]
 
         @self.__pg.production('boolean : valor GREATER_EQ valor')
@@ -184,17 +471,40 @@ class Parser:
         @self.__pg.production('boolean : valor DIST valor')
         @self.__pg.production('boolean : valor GREATER valor')
         @self.__pg.production('boolean : valor LOWER valor')
-        def boolean_bin(p):
-            return self.__ops[p[1].gettokentype()](p[0], p[2])
+        def boolean_bin(state, p):
+            # The types of the operands of a trusted rule were already checked
+            return self.__ops[p[1].gettokentype()](p[0], p[2], check=state.entity_types is None)
 
         @self.__pg.production('boolean : OR L_PAR extra R_PAR')
         @self.__pg.production('boolean : AND L_PAR extra R_PAR')
-        def boolean_log(p):
+        def boolean_log(state, p):
             return self.__ops[p[0].gettokentype()](p[2])
 
+        @self.__pg.production('boolean : SEQ L_PAR steps COMMA WITHIN DURATION R_PAR')
+        def sequence(state, p):
+            steps = p[2]
+            if len(steps) < 2:
+                raise ValueError('A sequence must have at least two steps.')
+            if any(negated for negated, _ in steps[:-1]):
+                raise ValueError('Only the last step of a sequence can be negated.')
+            return self.__ops['SEQ']([step for _, step in steps], p[5].value, steps[-1][0])
+
+        @self.__pg.production('steps : steps COMMA step')
+        @self.__pg.production('steps : step')
+        def steps(state, p):
+            if len(p) == 1:
+                return [p[0]]
+            else:
+                return p[0] + [p[2]]
+
+        @self.__pg.production('step : boolean')
+        @self.__pg.production('step : NOT boolean')
+        def step(state, p):
+            return (False, p[0]) if len(p) == 1 else (True, p[1])
+
         @self.__pg.production('extra : boolean COMMA extra')
         @self.__pg.production('extra : boolean')
-        def boolean_extra(p):
+        def boolean_extra(state, p):
             if len(p) == 1:
                 return [p[0]]
             else:
@@ -203,15 +513,27 @@ class Parser:
         @self.__pg.production('valor : DECIMAL')
         @self.__pg.production('valor : INTEGER')
         @self.__pg.production('valor : STRING')
-        def valor(p):
+        def valor(state, p):
             return self.__ops[p[0].gettokentype()](p[0].value)
 
-        @self.__pg.production('valor : ID DOT ID')
-        @self.__pg.production('valor : ID DOT STRING')
-        @self.__pg.production('valor : STRING DOT ID')
-        @self.__pg.production('valor : STRING DOT STRING')
-        def variable(p):
-            assert self.headers is not None, 'Lost headers while parsing rule.'
+        @self.__pg.production('valor : attribute')
+        def valor_attribute(state, p):
+            return p[0]
+
+        @self.__pg.production('valor : AVG L_PAR attribute COMMA DURATION R_PAR')
+        @self.__pg.production('valor : MAX L_PAR attribute COMMA DURATION R_PAR')
+        @self.__pg.production('valor : MIN L_PAR attribute COMMA DURATION R_PAR')
+        @self.__pg.production('valor : COUNT L_PAR attribute COMMA DURATION R_PAR')
+        @self.__pg.production('valor : RATE L_PAR attribute COMMA DURATION R_PAR')
+        def window_function(state, p):
+            function = p[0].gettokentype()
+            return self.__ops[function](function, p[2], p[4].value)
+
+        @self.__pg.production('attribute : ID DOT ID')
+        @self.__pg.production('attribute : ID DOT STRING')
+        @self.__pg.production('attribute : STRING DOT ID')
+        @self.__pg.production('attribute : STRING DOT STRING')
+        def variable(state, p):
             entity, _, attr = p
 
             entity_id = entity.value
@@ -222,13 +544,21 @@ class Parser:
             if attr.gettokentype() == 'STRING':
                 attr_id = String(attr_id).eval()
 
-            return Attribute(entity_id, attr_id, self.headers)
+            return Attribute(entity_id, attr_id, state.headers, (state.entity_types or {}).get(entity_id))
 
         @self.__pg.error
-        def error_handle(token):
+        def error_handle(state, token):
             raise ValueError(token)
 
-    def parse(self, tokenizer, headers):
+    def parse(self, tokenizer, headers, entity_types=None):
+        """
+        Parses a rule.
+        :param tokenizer: The tokens of the rule, as given by the Lexer.
+        :param headers: Headers (service and servicepath) to ask Orion.
+        :param entity_types: Types of the entities ({entity_id: type}) of a rule already validated. If informed, the
+        rule is trusted and nothing is checked in Orion.
+        :return: The root of the rule.
+        """
         if 'Fiware-Service' not in headers:
             raise ValueError('Lost Fiware-Service for parse the rule...')
         if 'Fiware-ServicePath' not in headers:
@@ -236,7 +566,5 @@ class Parser:
         if headers['Accept'] != 'application/json':
             raise ValueError('Headers must accept application/json to parse the rule')
 
-        self.headers = headers
-        the_rule = self.__parser.parse(tokenizer=tokenizer)
-        self.headers = None
-        return the_rule
+        # The state of each parse is given to the productions, so the same parser can be used by several threads
+        return self.__parser.parse(tokenizer=tokenizer, state=ParseState(headers, entity_types))
@@ -1,2 +1,4 @@
 from Compiler.Lexer import LexingError, Lexer
 from Compiler.Parser import Parser
+from Compiler.Codegen import compile_rule
+from Compiler.Cache import parse_cache
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import threading
+import time
+
+from config import cache_ttl, cache_size
+
+
+class EntityCache:
+    """
+    Values of the attributes of the entities, shared by every rule of the process. It is fed by the notifications and
+    by the reads to Orion. Each value expires after ttl seconds, and when there are more than max_size values the
+    least recently used ones are evicted.
+    """
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._values = OrderedDict()  # (service, servicepath, entity_id, attr) -> (value, timestamp)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def update(self, service: str, servicepath: str, context: dict, now=None):
+        """
+        Stores the values of a context.
+        :param context: Dict in the format {entity_id: {attr: value}}.
+        :param now: Timestamp of the values (time.monotonic()), now by default.
+        :return: List of (entity_id, attr) whose value has changed, or was not cached (valid).
+        """
+        if self.ttl <= 0:
+            return [(entity_id, attr) for entity_id, attrs in context.items() for attr in attrs]
+        changed = []
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for entity_id, attrs in context.items():
+                for attr, value in attrs.items():
+                    key = (service, servicepath, entity_id, attr)
+                    old = self._values.get(key)
+                    if old is None or old[0] != value or now - old[1] > self.ttl:
+                        changed.append((entity_id, attr))
+                    self._values[key] = (value, now)
+                    self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+        return changed
+
+    def lookup(self, service: str, servicepath: str, attributes, now=None):
+        """
+        Gets the values still valid of some attributes.
+        :param attributes: Iterable of (entity_id, attr).
+        :return: Dict in the format {entity_id: {attr: value}}, only with the attributes found.
+        """
+        found = {}
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for entity_id, attr in attributes:
+                key = (service, servicepath, entity_id, attr)
+                item = self._values.get(key)
+                if item is not None and now - item[1] > self.ttl:
+                    del self._values[key]
+                    self.expirations += 1
+                    item = None
+                if item is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._values.move_to_end(key)
+                found.setdefault(entity_id, {})[attr] = item[0]
+        return found
+
+    def __contains__(self, key):
+        """
+        :param key: (service, servicepath, entity_id, attr).
+        :return: If the attribute has a valid value. It does not count as a hit or a miss.
+        """
+        item = self._values.get(key)
+        return item is not None and time.monotonic() - item[1] <= self.ttl
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._values), 'max_size': self.max_size, 'ttl': self.ttl,
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else None,
+            'evictions': self.evictions, 'expirations': self.expirations
+        }
+
+    def __len__(self):
+        return len(self._values)
+
+
+class NotifiedValues:
+    """
+    Last notified value of each attribute, with when it was modified in Orion (its dateModified or TimeInstant metadata,
+    if notified), to know which attributes each notification changes. Unlike the EntityCache it is only fed by the
+    notifications, so a value read from Orion never hides the notification of its change. When there are more than
+    max_size attributes the least recently notified ones are forgotten, and their next notification is a change.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._values = OrderedDict()  # (service, servicepath, entity_id, attr) -> (value, modified)
+        self._lock = threading.Lock()
+
+    def changes(self, service: str, servicepath: str, context: dict, modified: dict = None):
+        """
+        Gets the attributes changed by a notification, without storing it (see commit).
+        :param context: Dict in the format {entity_id: {attr: value}}.
+        :param modified: When each attribute was modified, in the format {entity_id: {attr: modified}}.
+        :return: List of (entity_id, attr) whose value or modification has changed, or were not notified before.
+        """
+        modified = modified or {}
+        changed = []
+        with self._lock:
+            for entity_id, attrs in context.items():
+                for attr, value in attrs.items():
+                    old = self._values.get((service, servicepath, entity_id, attr))
+                    when = modified.get(entity_id, {}).get(attr)
+                    if old is None or old[0] != value or (when is not None and old[1] != when):
+                        changed.append((entity_id, attr))
+        return changed
+
+    def commit(self, service: str, servicepath: str, context: dict, modified: dict = None):
+        """
+        Stores the values of a notification, as in changes.
+        """
+        modified = modified or {}
+        with self._lock:
+            for entity_id, attrs in context.items():
+                for attr, value in attrs.items():
+                    key = (service, servicepath, entity_id, attr)
+                    self._values[key] = (value, modified.get(entity_id, {}).get(attr))
+                    self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def __len__(self):
+        return len(self._values)
+
+
+entity_cache = EntityCache(cache_ttl, cache_size)
+notified_values = NotifiedValues(cache_size)
@@ -0,0 +1,120 @@
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import cepheid_url, orion_url, orion_pool_size, orion_timeout, orion_retries, orion_backoff
+
+QUERY_PAGE = 1000  # Max. entities of a query, the max. limit of Orion
+
+# Every request to the Context Broker goes through this session, so the connections are kept alive and reused.
+# Only the idempotent methods (GET, DELETE...) are retried.
+_session = requests.Session()
+_session.mount(orion_url, HTTPAdapter(
+    pool_connections=1, pool_maxsize=orion_pool_size,
+    max_retries=Retry(total=orion_retries, backoff_factor=orion_backoff, status_forcelist=(502, 503, 504))
+))
+
+
+def get(path: str, headers: dict, **kwargs):
+    """
+    GET to Orion.
+    :param path: Path of the request, i.e. /v2/entities.
+    :param headers: Headers of the request (Fiware-Service...).
+    :return: The requests Response.
+    """
+    return _session.get(f'{orion_url}{path}', headers=headers, timeout=orion_timeout, **kwargs)
+
+
+def post(path: str, headers: dict, **kwargs):
+    return _session.post(f'{orion_url}{path}', headers=headers, timeout=orion_timeout, **kwargs)
+
+
+def patch(path: str, headers: dict, **kwargs):
+    return _session.patch(f'{orion_url}{path}', headers=headers, timeout=orion_timeout, **kwargs)
+
+
+def delete(path: str, headers: dict, **kwargs):
+    return _session.delete(f'{orion_url}{path}', headers=headers, timeout=orion_timeout, **kwargs)
+
+
+def query(entities: dict, attrs, headers: dict):
+    """
+    Gets the value of several attributes of several entities with a single request (POST /v2/op/query) per
+    QUERY_PAGE entities.
+    :param entities: Entities to ask, in the format {entity_id: type}.
+    :param attrs: Names of the attributes to retrieve.
+    :param headers: Headers of the request (Fiware-Service...).
+    :return: Dict in the format {entity_id: {attr: value}}.
+    """
+    post_headers = headers.copy()
+    post_headers['Content-Type'] = 'application/json'
+    entities = [{'id': entity_id, 'type': entity_type} for entity_id, entity_type in entities.items()]
+    values = {}
+    for start in range(0, len(entities), QUERY_PAGE):
+        body = {'entities': entities[start:start + QUERY_PAGE], 'attrs': sorted(attrs)}
+        response = post(f'/v2/op/query?options=keyValues&limit={QUERY_PAGE}', post_headers, data=json.dumps(body))
+        if response.status_code != 200:
+            raise ConnectionError(f'Error querying the entities. Status code: {response.status_code}')
+        for entity in response.json():
+            values[entity['id']] = {attr: value for attr, value in entity.items() if attr not in ('id', 'type')}
+    return values
+
+
+def _subscription(entities: list, attrs: list, description: str):
+    return {
+        "description": description,
+        "subject": {
+            "entities": entities,
+            "condition": {
+                "attrs": attrs
+            }
+        },
+        "notification": {
+            "http": {
+                "url": f"{cepheid_url}/notify"
+            },
+            "attrs": attrs,
+            "metadata": ["dateModified", "*"]  # To know which attributes each notification has changed
+        },
+        "throttling": 5
+    }
+
+
+def subscribe(entities: list, attrs: list, headers: dict, description='Subscription for a rule'):
+    """
+    Subscribes Cepheid (/notify) to the changes of some attributes.
+    :param entities: Entities of the subscription, in the format [{"id": id, "type": type}].
+    :param attrs: Attributes that trigger the notification, they are also the ones notified.
+    :return: The subscription id.
+    """
+    post_headers = headers.copy()
+    post_headers["Content-Type"] = "application/json"
+    response = post('/v2/subscriptions', post_headers, data=json.dumps(_subscription(entities, attrs, description)))
+    if response.status_code != 201:
+        raise ConnectionError('Something went wrong when trying to add a subscription for a rule.')
+    return response.headers['Location'].split('/')[-1]
+
+
+def update_subscription(subscription_id, entities: list, attrs: list, headers: dict,
+                        description='Subscription for a rule'):
+    """
+    Changes the entities and attributes of a subscription.
+    """
+    sub = _subscription(entities, attrs, description)
+    patch_headers = headers.copy()
+    patch_headers["Content-Type"] = "application/json"
+    response = patch(
+        f'/v2/subscriptions/{subscription_id}', patch_headers,
+        data=json.dumps({'subject': sub['subject'], 'notification': sub['notification']})
+    )
+    if response.status_code != 204:
+        raise ConnectionError(f'Something went wrong when trying to update the subscription {subscription_id}.')
+
+
+def unsubscribe(subscription_id, headers: dict):
+    """
+    :return: True if the subscription was deleted.
+    """
+    return delete(f'/v2/subscriptions/{subscription_id}', headers).status_code == 204
@@ -0,0 +1,77 @@
+import os
+import threading
+import weakref
+
+_per_process = weakref.WeakSet()  # Every PerProcess alive, to reset their locks after a fork
+
+
+class PerProcess:
+    """
+    Something created lazily once per process, i.e. threads or a pool of them: the threads do not survive a fork, so
+    each process (i.e. each worker of uWSGI) creates its own the first time it uses it.
+    """
+    def __init__(self, create):
+        """
+        :param create: Called without parameters to create it.
+        """
+        self._create = create
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+        _per_process.add(self)
+
+    def get(self):
+        """
+        :return: The one of this process, created if it does not exist.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._create()
+                    self._pid = os.getpid()
+        return self._value
+
+    def created(self):
+        return self._pid == os.getpid()
+
+
+def _after_fork():
+    for per_process in list(_per_process):
+        per_process._lock = threading.Lock()  # It could be held by a thread of the parent
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def start_thread(target, name: str, *args):
+    """
+    Starts a daemon thread, so it does not keep the process alive.
+    """
+    thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def worker_processes():
+    """
+    :return: Number of processes that serve the app: the workers of uWSGI, or 1 without it.
+    """
+    try:
+        import uwsgi
+    except ImportError:  # Served by this process (i.e. python main.py)
+        return 1
+    return uwsgi.numproc
+
+
+def require_single_process(feature: str):
+    """
+    Checks that the app is served by a single process, for the features whose state is kept in its memory: they must
+    see every notification, and uWSGI gives each one to any of its workers.
+    :raise ValueError: If there are several processes.
+    """
+    processes = worker_processes()
+    if processes > 1:
+        raise ValueError(
+            f'{feature} need every notification in the same process, and there are {processes} uWSGI workers. '
+            f'Run a single worker (processes = 1 in uwsgi.ini), its threads process the notifications.'
+        )
@@ -1,32 +1,78 @@
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
+import hashlib
 import json
 import re
 
-import requests
+import Orion
+from Commands import command_batcher
+from Entity_cache import entity_cache
+from Compiler import Lexer, Parser, LexingError, compile_rule, parse_cache
+from Compiler.Cache import normalize
+from config import plan_samples
+from Windows import parse_duration
 
-from Compiler import Lexer, Parser, LexingError
-from config import orion_url, cepheid_url
+
+class _RemoteAttributes(dict):
+    """
+    Values of an entity of the context with attributes that must be asked to Orion. They are asked, together with the
+    rest of missing attributes of the rule, the first time one of them is needed, so nothing is asked if the result of
+    the rule is decided before.
+    """
+    def __init__(self, entity_id, values, fetch):
+        super().__init__(values)
+        self._entity_id = entity_id
+        self._fetch = fetch
+
+    def __missing__(self, attr):
+        self._fetch()
+        assert dict.__contains__(self, attr), f'Error retrieving the value of {self._entity_id}.{attr}.'
+        return dict.__getitem__(self, attr)
 
 
 class Rule:
     _lexer = Lexer()
-    _parser = Parser()
+    _parser = Parser()  # Shared by every thread: the parse keeps no state in the parser
 
-    def __init__(self, rule: str, service: str, servicepath: str, true: str = None, false: str = None, subsId=None):
+    def __init__(self, rule: str, service: str, servicepath: str, true: str = None, false: str = None, subsId=None,
+                 trusted_types: dict = None):
+        """
+        :param trusted_types: Types already resolved of a validated rule, in the format
+        {'entities': [{'id': entity_id, 'type': type, 'attrs': [attr]}], 'true_type': type, 'false_type': type}, attrs
+        optional. If informed, nothing is
+        checked in Orion.
+        """
         self.headers = {
             'Accept': 'application/json',
             'Fiware-Service': service,
             'Fiware-ServicePath': servicepath
         }
+        self._trusted_types = trusted_types
+        self._shared = frozenset()  # Comparisons whose results are shared with other rules
         self.rule = rule
         self.true, self.false = true, false
+        self._trusted_types = None
         self._date_from, self._date_to = datetime(1900, 1, 1), datetime(9999, 12, 31)
         self._start_time, self._end_time = None, None
+        self._on_change = False
+        self._every, self._every_str = None, None
+        self._window = None  # (active, since, until) of the current activation window, see activity()
+        self.last_result = None  # Result of the last execution, kept to know when it changes
         self.subscription_id = subsId
 
     @classmethod
-    def from_dict(cls, rule: dict):
+    def from_dict(cls, rule: dict, trusted=False):
+        """
+        Builds a rule from its dict representation.
+        :param rule: The rule, as returned by to_dict.
+        :param trusted: If the rule was already validated (i.e. it comes from the database). When the types of its
+        entities and actions are stored, it is rebuilt without asking Orion.
+        """
         params = {p: rule.pop(p) for p in ['rule', 'service', 'servicepath', 'true', 'false', 'subsId'] if p in rule}
+        types = {p: rule.pop(p) for p in ['entities', 'true_type', 'false_type'] if p in rule}
+        if trusted and 'entities' in types and \
+           (params.get('true') is None or 'true_type' in types) and \
+           (params.get('false') is None or 'false_type' in types):
+            params['trusted_types'] = types
         new_rule = cls(**params)
         if 'date_from' in rule: new_rule.set_date_from(rule.pop('date_from'))
         if 'date_to' in rule: new_rule.set_date_to(rule.pop('date_to'))
@@ -34,23 +80,29 @@ class Rule:
             new_rule.set_schedule(rule.pop('start_time'), rule.pop('end_time'))
         elif 'start_time' in rule or 'end_time' in rule:
             raise ValueError('They must be both or none of the following attributes: [start_time, end_time] ')
+        if 'on_change' in rule: new_rule.set_on_change(rule.pop('on_change'))
+        if 'every' in rule: new_rule.set_every(rule.pop('every'))
+        if 'last_result' in rule: new_rule.last_result = rule.pop('last_result')
 
         if len(rule) != 0:
             raise ValueError(f'The following parameters do not belong to a rule: [{", ".join(rule)}]')
         return new_rule
 
-    def _check_action(self, action):
+    def _check_action(self, action, kind='true'):
         """
         Checks if action is in the entity of the action and the action itself exist and has the correct type.
         :param action: Action in the format <Entity_ID>.<Action>
+        :param kind: "true" or "false", the action of the rule it is. Used to take its type if the rule is trusted.
         :return: The entity type and the input action
         """
         if action is None:
             return None, None
+        if self._trusted_types is not None:
+            return self._trusted_types.get(f'{kind}_type'), action
         if re.match(r'[a-zA-Z_]\w+\.[a-zA-Z_]\w+$', action):  # Must tu have the format entity.command
             entity_id, command = action.split('.')
 
-            entity = requests.get(url=f'{orion_url}/v2/entities/{entity_id}', headers=self.headers)
+            entity = Orion.get(f'/v2/entities/{entity_id}', self.headers)
 
             if not 200 <= entity.status_code < 300:  # If not return anithing...
                 raise ValueError(f'The entity "{entity_id}" does not exist.')
@@ -98,9 +150,24 @@ class Rule:
 
     @rule.setter
     def rule(self, new_rule):
+        service, servicepath = self.headers['Fiware-Service'], self.headers['Fiware-ServicePath']
+        key = parse_cache.key(new_rule, service, servicepath)
         try:
-            self._rule = Rule._parser.parse(Rule._lexer.lex(new_rule), self.headers)
-            self._rule.eval()
+            if self._trusted_types is not None:
+                entity_types = {entity['id']: entity['type'] for entity in self._trusted_types['entities']}
+                cached = parse_cache.get(key)
+                if cached is None or any(entity_types.get(k) != v['type'] for k, v in cached[1].items()):
+                    cached = parse_cache.put(
+                        key, Rule._parser.parse(Rule._lexer.lex(new_rule), self.headers, entity_types)
+                    )
+            else:  # A new rule is always checked in Orion
+                tree = Rule._parser.parse(Rule._lexer.lex(new_rule), self.headers)
+                tree.eval()
+                cached = parse_cache.put(key, tree)
+            self._rule, self._entities = cached
+            # The results of the operands are observed for a while, then it is compiled again in the best order
+            self._evaluator = compile_rule(self._rule, observe=plan_samples > 0, shared=self._shared)
+            self._evaluations = 0
         except LexingError:
             pass
         self._rule_str = new_rule
@@ -119,7 +186,7 @@ class Rule:
 
     @false.setter
     def false(self, action):
-        self._false_type, self._false = self._check_action(action)
+        self._false_type, self._false = self._check_action(action, 'false')
 
     @property
     def date_from(self):
@@ -127,6 +194,7 @@ class Rule:
 
     def set_date_from(self, new_date_from):
         self._date_from = self._parse_date(new_date_from)
+        self._window = None
         return self
 
     @property
@@ -135,6 +203,7 @@ class Rule:
 
     def set_date_to(self, new_date_to):
         self._date_to = self._parse_date(new_date_to)
+        self._window = None
         return self
 
     @property
@@ -148,6 +217,41 @@ class Rule:
     def set_schedule(self, start_time, end_time):
         self._start_time = self._parse_time(start_time)
         self._end_time = self._parse_time(end_time)
+        self._window = None
+        return self
+
+    @property
+    def on_change(self):
+        return self._on_change
+
+    def set_on_change(self, on_change):
+        """
+        If True, the commands are only sent when the result of the rule changes, not in every execution.
+        """
+        if not isinstance(on_change, bool):
+            raise ValueError('on_change must be true or false')
+        self._on_change = on_change
+        return self
+
+    @property
+    def every(self):
+        """
+        Seconds between the periodic executions of the rule, or None if it is only executed by the notifications.
+        """
+        return self._every
+
+    def set_every(self, every):
+        """
+        :param every: Duration between the periodic executions (i.e. 30s, 5m), or None to not execute it periodically.
+        """
+        seconds = None
+        if every is not None:
+            if not isinstance(every, str):
+                raise ValueError('every must be a duration (i.e. 30s, 5m)')
+            seconds = parse_duration(every)
+            if seconds <= 0:
+                raise ValueError('every must be greater than 0')
+        self._every, self._every_str = seconds, every  # The text is stored as written, the format parse_duration reads
         return self
 
     def get_entities(self):
@@ -155,23 +259,129 @@ class Rule:
         Gets each entity and attributes involved in the rule.
         :return: Entity ID list.
         """
-        return {k: {"type": v["type"], "attrs": sorted(v['attrs'])}for k, v in self._rule.get_entities().items()}
+        return {k: {"type": v["type"], "attrs": sorted(v['attrs'])}for k, v in self._entities.items()}
+
+    @staticmethod
+    def build_context(entities: list):
+        """
+        Builds the evaluation context from the entities of a notification (the "data" of the body).
+        Both normalized and keyValues formats are supported.
+        :param entities: List of entities as Orion sends them.
+        :return: Dict in the format {entity_id: {attr: value}}.
+        """
+        context = {}
+        for entity in entities:
+            attrs = context.setdefault(entity['id'], {})
+            for attr, value in entity.items():
+                if attr in ('id', 'type'):
+                    continue
+                attrs[attr] = value['value'] if isinstance(value, dict) and 'value' in value else value
+        return context
+
+    @staticmethod
+    def build_modified(entities: list):
+        """
+        Gets when each attribute of a notification was modified in Orion, from its dateModified or TimeInstant metadata.
+        Only the normalized format has them.
+        :param entities: List of entities as Orion sends them.
+        :return: Dict in the format {entity_id: {attr: modified}}, only with the attributes that have it.
+        """
+        modified = {}
+        for entity in entities:
+            for attr, value in entity.items():
+                metadata = value.get('metadata') if isinstance(value, dict) else None
+                if not isinstance(metadata, dict) or attr in ('id', 'type'):
+                    continue
+                for name in ('dateModified', 'TimeInstant'):
+                    if isinstance(metadata.get(name), dict) and 'value' in metadata[name]:
+                        modified.setdefault(entity['id'], {})[attr] = metadata[name]['value']
+                        break
+        return modified
+
+    def _resolve(self, context):
+        """
+        Completes the context with the values of the attributes of the rule that are not in it. They are taken from the
+        cache, and the rest are asked to Orion in a single query when the first of them is needed. The given context is
+        not modified.
+        """
+        context = context or {}
+        missing = [a for a in self._evaluator.attributes if a.attr_id not in context.get(a.entity_id, ())]
+        if not missing:
+            return context
+        context = {entity_id: dict(attrs) for entity_id, attrs in context.items()}
+        service, servicepath = self.headers['Fiware-Service'], self.headers['Fiware-ServicePath']
+        cached = entity_cache.lookup(service, servicepath, [(a.entity_id, a.attr_id) for a in missing])
+        for entity_id, attrs in cached.items():
+            context.setdefault(entity_id, {}).update(attrs)
+        missing = [a for a in missing if a.attr_id not in context.get(a.entity_id, ())]
+        if not missing:
+            return context
+
+        def fetch():
+            if fetched:
+                return
+            fetched.append(True)
+            values = Orion.query({a.entity_id: a.type for a in missing}, {a.attr_id for a in missing}, self.headers)
+            entity_cache.update(service, servicepath, values)
+            for attribute in missing:
+                if attribute.attr_id in values.get(attribute.entity_id, {}):
+                    context[attribute.entity_id][attribute.attr_id] = values[attribute.entity_id][attribute.attr_id]
+
+        fetched = []
+        for entity_id in {a.entity_id for a in missing}:
+            context[entity_id] = _RemoteAttributes(entity_id, context.get(entity_id, {}), fetch)
+        return context
+
+    def predicates(self):
+        """
+        :return: Set with the normalized text of the comparisons of the rule that can be shared with other rules.
+        """
+        return {predicate.normalized() for predicate in self._rule.predicates()}
 
-    def eval(self):
+    def share(self, predicates):
+        """
+        Compiles the rule again to take the results of some comparisons from the memo of the event, where other rules
+        with them leave them.
+        :param predicates: Normalized text of the comparisons shared with other rules.
+        """
+        shared = frozenset(predicates) & self.predicates()
+        if shared != self._shared:
+            self._shared = shared
+            evaluator = self._evaluator
+            self._evaluator = compile_rule(
+                self._rule, observe=evaluator.observing, automata=evaluator.automata, shared=shared
+            )
+        return self
+
+    def eval(self, context=None, memo=None):
         """
         Check if the rule is true or false.
+        :param context: Known values of the attributes ({entity_id: {attr: value}}). The missing ones are looked up.
+        :param memo: Results of the shared comparisons in the current event, a dict shared by the rules evaluated for
+        it.
         :return: True or False depending on the rule.
         """
-        return self._rule.eval()
+        evaluator = self._evaluator
+        result = evaluator(self._resolve(context), memo)
+        if evaluator.observing:
+            self._evaluations += 1
+            if self._evaluations == plan_samples:  # Enough observations, the operands are reordered
+                self._evaluator = compile_rule(self._rule, automata=evaluator.automata, shared=self._shared)
+        return result
 
-    def can_execute(self):
+    def explain(self):
         """
-        Check if is in date and in the programmed scheule (if exists).
-        :return: True if can be executed, false otherwise.
+        :return: The plan of the evaluation: the order of the operands with their estimated cost and observed
+        selectivity, and the generated code.
         """
+        return {
+            'plan': self._rule.explain(), 'source': self._evaluator.source, 'observing': self._evaluator.observing,
+            'evaluations': self._evaluations
+        }
+
+    def _active_at(self, now: datetime):
         assert (self.start_time is not None) == (self.end_time is not None), \
             'Must be informed the two hours, or none'
-        now = datetime.now()  # Check if the rule can be executed
         if not (self.date_from <= now <= self.date_to):
             return False  # It would not be within the dates
         if self.start_time and self.end_time:
@@ -183,15 +393,55 @@ class Rule:
                     return False
         return True
 
-    def execute(self):
+    def activity(self, now: datetime = None):
+        """
+        Gets if the rule can be executed, and until when.
+        :param now: The instant checked, now by default.
+        :return: (active, until): if it can be executed at now, and the next instant it could change (when its dates or
+        its schedule start or end), None if never.
+        """
+        now = datetime.now() if now is None else now
+        step = timedelta(microseconds=1)  # The ends are included, so it changes just after them
+        changes = [self.date_from, self.date_to + step]
+        if self.start_time and self.end_time:
+            for day in (now.date(), now.date() + timedelta(days=1)):
+                changes += [datetime.combine(day, self.start_time), datetime.combine(day, self.end_time) + step]
+        return self._active_at(now), min((change for change in changes if change > now), default=None)
+
+    def can_execute(self):
+        """
+        Check if is in date and in the programmed scheule (if exists).
+        The result is kept until the dates or the schedule start or end, so they are not checked on every call.
+        :return: True if can be executed, false otherwise.
+        """
+        now = datetime.now()  # Check if the rule can be executed
+        window = self._window
+        if window is None or not (window[1] <= now and (window[2] is None or now < window[2])):
+            active, until = self.activity(now)
+            window = self._window = (active, now, until)
+        return window[0]
+
+    def execute(self, context=None, checkpoint=None, memo=None):
         """
         If everithing is OK, evaluate the rule itself and execute the pertinent command
+        :param context: Known values of the attributes, as in eval.
+        :param memo: Results of the shared comparisons in the current event, as in eval.
+        :param checkpoint: For the on_change rules, called with every result to persist it. It must return True only if
+        it differs from the persisted one, and the command is only sent then: the last_result of this worker can be
+        out of date, as other workers execute the rule too. Without it, the result is compared with last_result.
         :return: The result of evaluation if it can be executed, None otherwise.
         """
         if not self.can_execute():
             return None
 
-        if result := self.eval():
+        result = self.eval(context, memo)
+        if self.on_change:
+            changed = checkpoint(result) if checkpoint is not None else result != self.last_result
+            self.last_result = result
+            if not changed:
+                return result
+
+        if result:
             to_execute = self.true
             entity_type = self._true_type
         else:
@@ -199,22 +449,12 @@ class Rule:
             entity_type = self._false_type
         if to_execute is not None:
             entity_id, command = to_execute.split('.')
-
-            payload = {
-                "actionType": "update",
-                "entities": [
-                    {
-                        "type": entity_type,
-                        "id": entity_id,
-                        command: {"type": "command", "value": ""}
-                    }
-                ]
-            }
-            post_headers = self.headers.copy()
-            post_headers['Content-Type'] = 'application/json'
-            res = requests.post(f'{orion_url}/v2/op/update', headers=post_headers, data=json.dumps(payload))
-            if res.status_code != 204:
-                raise ConnectionError(f'Error running the command. Status code: {res.status_code}')
+            # Sent together with the other commands of the same service and servicepath of the batching window
+            command_batcher.send(self.headers, {
+                "type": entity_type,
+                "id": entity_id,
+                command: {"type": "command", "value": ""}
+            })
         return result
 
     def subscribe(self):
@@ -227,36 +467,15 @@ class Rule:
             total_attrs.extend(attrs['attrs'])
             total_nttys.append({'id': entity, 'type': attrs['type']})
 
-        sub = {
-            "description": "Subscription for a rule",
-            "subject": {
-                "entities": total_nttys,
-                "condition": {
-                    "attrs": total_attrs
-                }
-            },
-            "notification": {
-                "http": {
-                    "url": f"{cepheid_url}/notify"
-                },
-                "attrs": total_attrs
-            },
-            "throttling": 5
-        }
-        post_headers = self.headers.copy()
-        post_headers["Content-Type"] = "application/json"
-        response = requests.post(f'{orion_url}/v2/subscriptions', data=json.dumps(sub), headers=post_headers)
-        if response.status_code != 201:
-            raise ConnectionError('Something went wrong when trying to add a subscription for a rule.')
-        self.subscription_id = response.headers['Location'].split('/')[-1]
+        self.subscription_id = Orion.subscribe(total_nttys, total_attrs, self.headers)
         return True
 
     def unsubscribe(self):
         if self.subscription_id is None:
             return None
-        response = requests.delete(f'{orion_url}/v2/subscriptions/{self.subscription_id}', headers=self.headers)
+        deleted = Orion.unsubscribe(self.subscription_id, self.headers)
         self.subscription_id = None
-        return response.status_code == 204
+        return deleted
 
     def to_dict(self):
         the_dict = {
@@ -267,14 +486,40 @@ class Rule:
         if self.true is not None: the_dict['true'] = self.true
         if self.false is not None: the_dict['false'] = self.false
 
+        # Types already validated, to rebuild the rule without asking Orion
+        # With their attributes, to find the rules that use an attribute without building them
+        the_dict['entities'] = [
+            {'id': entity_id, 'type': v['type'], 'attrs': v['attrs']} for entity_id, v in self.get_entities().items()
+        ]
+        if self._true_type is not None: the_dict['true_type'] = self._true_type
+        if self._false_type is not None: the_dict['false_type'] = self._false_type
+
         if self.date_from is not None: the_dict['date_from'] = self.date_from.strftime('%d/%m/%Y')
         if self.date_to is not None: the_dict['date_to'] = self.date_to.strftime('%d/%m/%Y')
 
         if self.start_time is not None: the_dict['start_time'] = self.start_time.strftime('%H:%M')
         if self.end_time is not None: the_dict['end_time'] = self.end_time.strftime('%H:%M')
 
+        if self.on_change: the_dict['on_change'] = True
+        if self.every is not None: the_dict['every'] = self._every_str
+
         return the_dict
 
+    @staticmethod
+    def content_hash(the_dict: dict):
+        """
+        Hash of what identifies a rule: two rules with the same hash are the same rule.
+        :param the_dict: The rule, as returned by to_dict.
+        :return: Hexadecimal SHA-256.
+        """
+        fields = ['service', 'servicepath', 'true', 'false', 'date_from', 'date_to', 'start_time', 'end_time']
+        content = {field: the_dict.get(field) for field in fields}
+        content['rule'] = normalize(the_dict['rule'])
+        content['on_change'] = the_dict.get('on_change', False)
+        if the_dict.get('every') is not None:  # Only when informed, to keep the hashes of the other rules
+            content['every'] = parse_duration(the_dict['every'])
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
     def __str__(self):
         return self.rule
 
@@ -282,7 +527,8 @@ class Rule:
         if self.rule != other.rule or self.headers != other.headers or \
            self.true != other.true or self.false != other.false or \
            self.date_from != other.date_from or self.date_to != other.date_to or \
-           self.start_time != other.start_time or self.end_time != other.end_time:
+           self.start_time != other.start_time or self.end_time != other.end_time or \
+           self.on_change != other.on_change or self.every != other.every:
             return False
         return True
 
@@ -1,44 +1,169 @@
+import logging
+import time
+
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from Rule import Rule
 from config import CEP_MONGO_HOST, CEP_MONGO_PORT, CEP_MONGO_DB
 
+logger = logging.getLogger(__name__)
+
 
 class RulesDB:
     instance = None
 
     _client = MongoClient(CEP_MONGO_HOST, int(CEP_MONGO_PORT))
     _rules_db = _client[CEP_MONGO_DB]['rules']
+    _leases = _client[CEP_MONGO_DB]['leases']
 
     def __new__(cls):
         if cls.instance is None:
             cls.instance = object.__new__(cls)
-            if not any('subsId' in idx['name'] for idx in cls._rules_db.list_indexes()):
+            index_names = [idx['name'] for idx in cls._rules_db.list_indexes()]
+            if not any('subsId' in name for name in index_names):
                 cls._rules_db.create_index('subsId')
+            if not any('entities.id' in name for name in index_names):
+                cls._rules_db.create_index('entities.id')
+            cls._backfill_entity_attrs()
+            if not any('hash' in name for name in index_names):
+                cls._backfill_hashes()
+                # The same rule cannot be inserted twice, even by two workers at the same time
+                cls._rules_db.create_index(
+                    [('service', ASCENDING), ('servicepath', ASCENDING), ('hash', ASCENDING)], unique=True
+                )
         return cls.instance
 
+    @classmethod
+    def _backfill_hashes(cls):
+        """
+        Stores the hash of the rules inserted before it existed. The duplicated ones are kept with a distinct hash.
+        """
+        for doc in cls._rules_db.find({'hash': {'$exists': False}}):
+            content_hash = Rule.content_hash(doc)
+            key = {'service': doc['service'], 'servicepath': doc['servicepath'], 'hash': content_hash}
+            if cls._rules_db.find_one(key, {'_id': True}) is not None:
+                logger.warning(f'The rule {doc["_id"]} is duplicated.')
+                content_hash = f'{content_hash}-{doc["_id"]}'
+            cls._rules_db.update_one({'_id': doc['_id']}, {'$set': {'hash': content_hash}})
+
+    @classmethod
+    def _backfill_entity_attrs(cls):
+        """
+        Stores the attributes of the entities of the rules inserted before they were stored.
+        """
+        for doc in cls._rules_db.find({'entities': {'$elemMatch': {'attrs': {'$exists': False}}}}, {'hash': False}):
+            stored = {k: v for k, v in doc.items() if k not in ('_id', 'last_result')}
+            try:
+                entities = Rule.from_dict(stored, trusted=True).to_dict()['entities']
+            except Exception as e:
+                logger.error(f'The entities of the rule {doc["_id"]} cannot be updated: {e}')
+                continue
+            cls._rules_db.update_one({'_id': doc['_id']}, {'$set': {'entities': entities}})
+
     def get_all(self, service: str, servicepath: str, in_json=False):
         if in_json:
             rules = []
-            for r in self._rules_db.find({'service': service, 'servicepath': servicepath}):
+            for r in self._rules_db.find({'service': service, 'servicepath': servicepath}, {'hash': False}):
                 r['id'] = str(r.pop('_id'))
                 rules.append(r)
             return rules
         else:
-            return [Rule.from_dict(r) for r in self._rules_db.find({'service': service, 'servicepath': servicepath}, {'_id': False})]
+            query = {'service': service, 'servicepath': servicepath}
+            return [Rule.from_dict(r, trusted=True) for r in self._rules_db.find(query, {'_id': False, 'hash': False})]
+
+    def iter_rules(self, service: str, servicepath: str, limit=0, offset=0, after=None, fields=None):
+        """
+        Iterates over the rules of a service and servicepath in the order of their ids, reading them from the cursor
+        without loading them all.
+        :param limit: Max. number of rules, 0 for all of them.
+        :param offset: Number of rules skipped.
+        :param after: Id of a rule, only the following ones are returned (the last one of the previous page).
+        :param fields: Fields of each rule, all of them by default. The id is always returned.
+        :return: Iterator of dicts, as the ones of get_all with in_json.
+        """
+        query = {'service': service, 'servicepath': servicepath}
+        if after is not None:
+            query['_id'] = {'$gt': ObjectId(after)}
+        if fields:
+            projection = {field: True for field in fields if field not in ('id', 'hash')} or {'_id': True}
+        else:
+            projection = {'hash': False}
+        cursor = self._rules_db.find(query, projection).sort('_id', ASCENDING).skip(offset).limit(limit)
+        for r in cursor:
+            r['id'] = str(r.pop('_id'))
+            yield r
+
+    def iter_all(self):
+        """
+        Iterates over the rules of every service and servicepath, with a single query.
+        :return: Iterator of dicts, as the ones of get_all with in_json.
+        """
+        for r in self._rules_db.find({}, {'hash': False}):
+            r['id'] = str(r.pop('_id'))
+            yield r
+
+    def iter_by_attribute(self, entity_id, attr: str, service: str, servicepath: str):
+        """
+        Iterates over the rules of a service and servicepath that use an attribute of an entity.
+        :return: Iterator of dicts, as the ones of get_all with in_json.
+        """
+        query = {
+            'service': service, 'servicepath': servicepath, 'entities': {'$elemMatch': {'id': entity_id, 'attrs': attr}}
+        }
+        for r in self._rules_db.find(query, {'hash': False}).sort('_id', ASCENDING):
+            r['id'] = str(r.pop('_id'))
+            yield r
+
+    def iter_periodic(self):
+        """
+        Iterates over the periodic rules (the ones with "every") of every service and servicepath.
+        :return: Iterator of (id, service, servicepath).
+        """
+        for r in self._rules_db.find({'every': {'$exists': True}}, {'service': True, 'servicepath': True}):
+            yield str(r['_id']), r['service'], r['servicepath']
+
+    def count(self, service: str, servicepath: str):
+        return self._rules_db.count_documents({'service': service, 'servicepath': servicepath})
 
     def insert(self, rule: Rule):
         """
         Save a rule to the database
         :param rule: The rule to persist.
         :return: The ObjectID string.
+        :raise DuplicateKeyError: If the rule already exists.
         """
-        res = self._rules_db.insert_one(rule.to_dict())
+        doc = rule.to_dict()
+        doc['hash'] = Rule.content_hash(doc)
+        res = self._rules_db.insert_one(doc)
         return str(res.inserted_id)
 
+    def insert_many(self, rules: list):
+        """
+        Saves several rules in a single request.
+        :param rules: The rules to persist.
+        :return: List with the ObjectID string of each rule, None for the ones that already exist.
+        """
+        if not rules:
+            return []
+        docs = [rule.to_dict() for rule in rules]
+        for doc in docs:
+            doc['hash'] = Rule.content_hash(doc)
+        duplicated = set()
+        try:  # Unordered, so a duplicated rule does not stop the rest
+            self._rules_db.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(error['code'] != 11000 for error in errors):  # Not a duplicate key
+                raise
+            duplicated = {error['index'] for error in errors}
+        return [None if i in duplicated else str(doc['_id']) for i, doc in enumerate(docs)]
+
     def find_by_id(self, id, service: str, servicepath: str, in_json=False):
-        rule = self._rules_db.find_one({'_id': ObjectId(id), 'service': service, 'servicepath': servicepath})
+        rule = self._rules_db.find_one(
+            {'_id': ObjectId(id), 'service': service, 'servicepath': servicepath}, {'hash': False}
+        )
         if rule is None:
             return None
         if in_json:
@@ -46,13 +171,26 @@ class RulesDB:
             return rule
         else:
             rule.pop('_id')
-            return Rule.from_dict(rule)
+            return Rule.from_dict(rule, trusted=True)
+
+    def find_by_subscription_id(self, subscription_id, service: str, servicepath: str, in_json=False):
+        r = self._rules_db.find_one(
+            {'subsId': subscription_id, 'service': service, 'servicepath': servicepath}, {'hash': False}
+        )
+        if r is None:
+            return None
+        if in_json:
+            r['id'] = str(r.pop('_id'))
+            return r
+        else:
+            r.pop('_id')
+            return Rule.from_dict(r, trusted=True)
 
-    def find_by_subscription_id(self, subscription_id, service: str, servicepath: str):
-        r = self._rules_db.find_one({'subsId': subscription_id, 'service': service, 'servicepath': servicepath}, {'_id': False})
-        if r:
-            return Rule.from_dict(r)
-        return None
+    def _find_by_hash(self, rule: Rule):
+        return self._rules_db.find_one({
+            'service': rule.headers['Fiware-Service'], 'servicepath': rule.headers['Fiware-ServicePath'],
+            'hash': Rule.content_hash(rule.to_dict())
+        }, {'_id': True})
 
     def delete_by_id(self, id, service: str, servicepath: str):
         rule = self.find_by_id(id, service, servicepath)
@@ -62,15 +200,36 @@ class RulesDB:
         return self._rules_db.delete_one({'_id': ObjectId(id), 'service': service, 'servicepath': servicepath}).deleted_count == 1
 
     def delete(self, rule: Rule):
-        ids = []
-        rules_in_db = []
-        for r in self._rules_db.find({"rule": rule.rule}):
-            ids.append(r.pop('_id'))
-            rules_in_db.append(Rule.from_dict(r))
+        doc = self._find_by_hash(rule)
+        if doc is None:
+            return False
+        return self.delete_by_id(doc['_id'], rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath'])
 
-        if rule in rules_in_db:
-            return self.delete_by_id(ids[rules_in_db.index(rule)], rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath'])
-        return False
+    def save_state(self, id, last_result):
+        """
+        Persists the last result of a rule.
+        :return: True if it has changed, False if it was already stored.
+        """
+        res = self._rules_db.update_one(
+            {'_id': ObjectId(id), 'last_result': {'$ne': last_result}}, {'$set': {'last_result': last_result}}
+        )
+        return res.modified_count == 1
+
+    def acquire_lease(self, name: str, owner: str, seconds: float):
+        """
+        Takes or renews a lease that only one owner has at a time, i.e. so only one worker does something. If the owner
+        does not renew it, another one can take it when it expires.
+        :return: True if the owner has the lease.
+        """
+        now = time.time()
+        try:
+            self._leases.find_one_and_update(
+                {'_id': name, '$or': [{'owner': owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires': now + seconds}}, upsert=True
+            )
+            return True
+        except DuplicateKeyError:  # Not matched, so the upsert inserts the same _id: other owner has it
+            return False
 
     def get_services(self):
         return [
@@ -81,6 +240,4 @@ class RulesDB:
         ]
 
     def __contains__(self, rule):
-        rules_in_db = [Rule.from_dict(r) for r in self._rules_db.find({"rule": rule.rule}, {'_id': False})]
-        return rule in rules_in_db
-
+        return self._find_by_hash(rule) is not None
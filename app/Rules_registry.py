@@ -0,0 +1,236 @@
+from datetime import datetime
+import heapq
+import itertools
+import logging
+import threading
+
+from Rule import Rule
+
+logger = logging.getLogger(__name__)
+
+
+class RulesRegistry:
+    """
+    Resident index of the already built rules, so a notification only costs a dictionary lookup.
+    The rules are indexed by the rule id of the database, and by (service, servicepath, subscription id) the ones with
+    their own subscription. The rules of the shared subscriptions are given by the SubscriptionManager.
+    It also keeps which rules depend on each attribute, (service, servicepath, entity, attr), to evaluate only the rules
+    whose inputs have changed, and which rules have each comparison, so the ones shared by several rules are evaluated
+    once per event. The periodic rules are also given to the scheduler, if any.
+    The rules out of their dates or schedule are inactive: their notifications are dropped before any work. When each
+    rule becomes active or inactive is kept in a heap, so nothing is checked per notification until that instant.
+    """
+    instance = None
+
+    def __new__(cls, rules_db, subscriptions, scheduler=None):
+        if cls.instance is None:
+            cls.instance = object.__new__(cls)
+            cls.instance._rules_db = rules_db
+            cls.instance._subscriptions = subscriptions
+            cls.instance._scheduler = scheduler
+            cls.instance._lock = threading.RLock()
+            cls.instance._rules = {}  # rule id -> Rule
+            cls.instance._by_subscription = {}  # (service, servicepath, subsId) -> rule id
+            cls.instance._by_attribute = {}  # (service, servicepath, entity_id, attr) -> {rule ids}
+            cls.instance._by_predicate = {}  # (service, servicepath, normalized comparison) -> {rule ids}
+            cls.instance._inactive = set()  # rule ids out of their dates or schedule
+            cls.instance._changes = []  # (instant, sequence number, rule id) in which a rule could become (in)active
+            cls.instance._next_change = {}  # rule id -> sequence number of its entry in _changes, the others are stale
+            cls.instance._sequence = itertools.count()
+        return cls.instance
+
+    def load(self):
+        """
+        Builds every rule stored in the database.
+        :return: The number of rules loaded.
+        """
+        for service, servicepath in self._rules_db.get_services():
+            for doc in self._rules_db.get_all(service, servicepath, in_json=True):
+                rule_id = doc.pop('id')
+                try:
+                    self.add(rule_id, Rule.from_dict(doc, trusted=True))
+                except Exception as e:
+                    logger.error(f'The rule {rule_id} cannot be loaded: {e}')
+        return len(self)
+
+    @staticmethod
+    def _attributes(rule: Rule):
+        service, servicepath = rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath']
+        return [
+            (service, servicepath, entity_id, attr)
+            for entity_id, entity in rule.get_entities().items() for attr in entity['attrs']
+        ]
+
+    @staticmethod
+    def _predicates(rule: Rule):
+        service, servicepath = rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath']
+        return [(service, servicepath, predicate) for predicate in rule.predicates()]
+
+    def _share(self, rule_ids):
+        """
+        Tells some rules which of their comparisons are shared with other rules.
+        """
+        for rule_id in rule_ids:
+            rule = self._rules.get(rule_id)
+            if rule is not None:
+                rule.share(key[2] for key in self._predicates(rule) if len(self._by_predicate[key]) > 1)
+
+    def _track(self, rule_id, rule: Rule, now: datetime):
+        active, until = rule.activity(now)
+        if active:
+            self._inactive.discard(rule_id)
+        else:
+            self._inactive.add(rule_id)
+        if until is None:
+            self._next_change.pop(rule_id, None)
+        else:
+            sequence = next(self._sequence)
+            self._next_change[rule_id] = sequence
+            heapq.heappush(self._changes, (until, sequence, rule_id))
+
+    def _update_activity(self):
+        """
+        Activates and deactivates the rules whose dates or schedule have started or ended.
+        """
+        now = datetime.now()
+        if not self._changes or self._changes[0][0] > now:  # Nothing to do, without taking the lock
+            return
+        with self._lock:
+            while self._changes and self._changes[0][0] <= now:
+                _, sequence, rule_id = heapq.heappop(self._changes)
+                if self._next_change.get(rule_id) == sequence:
+                    self._track(rule_id, self._rules[rule_id], now)
+
+    def is_active(self, rule_id):
+        self._update_activity()
+        return rule_id not in self._inactive
+
+    def add(self, rule_id, rule: Rule):
+        with self._lock:
+            self.remove(rule_id)
+            self._rules[rule_id] = rule
+            self._track(rule_id, rule, datetime.now())
+            for key in self._attributes(rule):
+                self._by_attribute.setdefault(key, set()).add(rule_id)
+            affected = {rule_id}
+            for key in self._predicates(rule):
+                sharing = self._by_predicate.setdefault(key, set())
+                sharing.add(rule_id)
+                if len(sharing) == 2:  # Now shared, the other rule must share it too
+                    affected.update(sharing)
+            self._share(affected)
+            if rule.subscription_id is not None:
+                key = (rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath'], rule.subscription_id)
+                self._by_subscription[key] = rule_id
+            if rule.every is not None and self._scheduler is not None:
+                self._scheduler.schedule(rule_id, rule.every)
+        return rule
+
+    def remove(self, rule_id):
+        with self._lock:
+            rule = self._rules.pop(rule_id, None)
+            if rule is None:
+                return None
+            self._inactive.discard(rule_id)
+            self._next_change.pop(rule_id, None)
+            if rule.every is not None and self._scheduler is not None:
+                self._scheduler.unschedule(rule_id)
+            for key in self._attributes(rule):
+                dependents = self._by_attribute.get(key, set())
+                dependents.discard(rule_id)
+                if not dependents:
+                    self._by_attribute.pop(key, None)
+            affected = set()
+            for key in self._predicates(rule):
+                sharing = self._by_predicate.get(key, set())
+                sharing.discard(rule_id)
+                if len(sharing) == 1:  # No longer shared
+                    affected.update(sharing)
+                elif not sharing:
+                    self._by_predicate.pop(key, None)
+            self._share(affected)
+            if rule.subscription_id is not None:
+                key = (rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath'], rule.subscription_id)
+                self._by_subscription.pop(key, None)
+            return rule
+
+    def find(self, rule_id, service: str, servicepath: str):
+        """
+        Gets a rule by its id. If it is not in memory (i.e. inserted by another worker) it is retrieved from the
+        database and kept.
+        :return: The rule, or None if it does not exist.
+        """
+        rule = self._rules.get(rule_id)
+        if rule is None:
+            rule = self._rules_db.find_by_id(rule_id, service, servicepath)
+            if rule is None:
+                return None
+            self.add(rule_id, rule)
+        return rule
+
+    def rules(self, rule_ids):
+        """
+        Gets the active rules in memory among some ids.
+        :return: Dict in the format {rule id: Rule}.
+        """
+        self._update_activity()
+        rules = ((rule_id, self._rules.get(rule_id)) for rule_id in rule_ids if rule_id not in self._inactive)
+        return {rule_id: rule for rule_id, rule in rules if rule is not None}
+
+    def get(self, service: str, servicepath: str, subscription_id):
+        """
+        Gets the active rules notified by a subscription: the rule of its own subscription or the rules sharing it.
+        The rules not in memory (i.e. inserted by another worker) are retrieved from the database and kept.
+        :return: Dict in the format {rule id: Rule}, empty if they are all inactive, or None if there are no rules for
+        the subscription.
+        """
+        self._update_activity()
+        rule_id = self._by_subscription.get((service, servicepath, subscription_id))
+        if rule_id is not None:
+            return {} if rule_id in self._inactive else {rule_id: self._rules[rule_id]}
+
+        rule_ids = self._subscriptions.rules_of(service, servicepath, subscription_id)
+        if rule_ids is not None:
+            active = [rule_id for rule_id in rule_ids if rule_id not in self._inactive]
+            rules = {rule_id: self.find(rule_id, service, servicepath) for rule_id in active}
+            rules = {rule_id: rule for rule_id, rule in rules.items() if rule is not None}
+            return rules if rules or len(active) < len(rule_ids) else None
+
+        # A rule with its own subscription inserted by another worker
+        doc = self._rules_db.find_by_subscription_id(subscription_id, service, servicepath, in_json=True)
+        if doc is None:
+            return None
+        rule_id = doc.pop('id')
+        rule = self.add(rule_id, Rule.from_dict(doc, trusted=True))
+        return {} if rule_id in self._inactive else {rule_id: rule}
+
+    def dependents(self, service: str, servicepath: str, attributes):
+        """
+        Gets the rules that depend on some attributes.
+        :param attributes: Iterable of (entity_id, attr).
+        :return: Set of rule ids.
+        """
+        rule_ids = set()
+        for entity_id, attr in attributes:
+            rule_ids.update(self._by_attribute.get((service, servicepath, entity_id, attr), ()))
+        return rule_ids
+
+    def predicate_stats(self):
+        shared = [rule_ids for rule_ids in self._by_predicate.values() if len(rule_ids) > 1]
+        return {
+            'distinct': len(self._by_predicate), 'shared': len(shared),
+            'references': sum(len(rule_ids) for rule_ids in self._by_predicate.values())
+        }
+
+    def activity_stats(self):
+        self._update_activity()
+        return {
+            'active': len(self._rules) - len(self._inactive), 'inactive': len(self._inactive),
+            'next_change': self._changes[0][0].isoformat() if self._changes else None
+        }
+
+    def __contains__(self, rule_id):
+        return rule_id in self._rules
+
+    def __len__(self):
+        return len(self._rules)
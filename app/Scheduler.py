@@ -0,0 +1,126 @@
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from Process import PerProcess, start_thread
+
+logger = logging.getLogger(__name__)
+
+
+class RuleScheduler:
+    """
+    Runs the periodic rules (the ones with "every") from a single thread. The next run of each rule is kept in a heap,
+    and the rules due within the same tick are run together, so their entities are asked to Orion at once.
+    The first run of a rule is at a random point of its first period, to spread the rules with the same period. If a
+    run is late for more than a period, the missed runs are skipped, not run one after another.
+    """
+    def __init__(self, tick: float, run, sync=None, sync_every: float = 30, is_leader=None):
+        """
+        :param tick: Seconds within which the rules due are run together.
+        :param run: Called with the list of ids of the rules to run.
+        :param sync: Called every sync_every seconds, i.e. to schedule the rules inserted by other workers.
+        :param is_leader: Called before each run. If it returns False (other worker runs the rules), nothing is run.
+        """
+        self.tick = tick
+        self._run = run
+        self._sync = sync
+        self.sync_every = sync_every
+        self._is_leader = is_leader or (lambda: True)
+        self._heap = []  # (due, sequence number, rule id, period)
+        self._scheduled = {}  # rule id -> sequence number of its entry in the heap, the others are discarded
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = PerProcess(lambda: start_thread(self._work, 'cepheid-scheduler'))
+        self.runs = self.batches = self.missed = self.errors = 0
+
+    def start(self):
+        """
+        Starts the thread in this process, i.e. when the app is served without forking workers.
+        """
+        self._thread.get()
+
+    def start_after_fork(self):
+        """
+        Starts the thread in each process forked from this one (i.e. the workers of uWSGI), but not in this one, so the
+        master process that imports the app does not run rules.
+        """
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        self._cond = threading.Condition()  # Its lock could be held by a thread of the parent
+        self._thread.get()
+
+    def _push(self, rule_id, due, period):
+        sequence = next(self._sequence)
+        self._scheduled[rule_id] = sequence
+        heapq.heappush(self._heap, (due, sequence, rule_id, period))
+
+    def schedule(self, rule_id, period: float, now=None):
+        """
+        Runs a rule every period seconds, replacing its previous schedule. Nothing is run until the scheduler is started.
+        """
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            self._push(rule_id, now + random.uniform(0, period), period)
+            self._cond.notify()
+
+    def unschedule(self, rule_id):
+        with self._cond:
+            self._scheduled.pop(rule_id, None)
+
+    def scheduled(self):
+        return list(self._scheduled)
+
+    def _pop_due(self, now):
+        """
+        Takes the rules due until the end of the current tick, and schedules their next runs.
+        :return: List of rule ids.
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now + self.tick:
+            at, sequence, rule_id, period = heapq.heappop(self._heap)
+            if self._scheduled.get(rule_id) != sequence:  # Unscheduled or scheduled again
+                continue
+            self.missed += max(int((now - at) // period), 0)
+            # The next run after this tick, so a rule shorter than the tick does not run twice in the same batch
+            self._push(rule_id, at + (int((now + self.tick - at) // period) + 1) * period, period)
+            due.append(rule_id)
+        return due
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f'Error running the periodic rules: {e}')
+
+    def _work(self):
+        next_sync = time.monotonic()
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                timeouts = [next_sync - now] if self._sync is not None else []
+                if self._heap:
+                    timeouts.append(self._heap[0][0] - now)
+                timeout = min(timeouts) if timeouts else None
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+                    now = time.monotonic()
+                due = self._pop_due(now)
+            if self._sync is not None and now >= next_sync:
+                next_sync = now + self.sync_every
+                self._call(self._sync)
+            if due and self._is_leader():
+                self.batches += 1
+                self.runs += len(due)
+                self._call(self._run, due)
+
+    def stats(self):
+        return {
+            'scheduled': len(self._scheduled), 'tick': self.tick, 'batches': self.batches, 'runs': self.runs,
+            'missed': self.missed, 'errors': self.errors
+        }
@@ -0,0 +1,100 @@
+from collections import deque
+import threading
+import time
+import weakref
+
+from config import seq_max_partials
+
+_automata = weakref.WeakSet()  # Every automaton alive, for the stats
+
+
+class SequenceAutomaton:
+    """
+    Detects a sequence of steps, each one a condition of the rule, that happen in order within a window of time.
+    A step happens when its condition becomes true (it was false in the previous evaluation), so a condition that stays
+    true does not happen again. It is fed on every evaluation of its rule, with the result of each condition.
+    If the last step is negated, the sequence matches when the window expires without it happening. As nothing is
+    evaluated without notifications, the match is detected on the first evaluation after the expiration.
+    At most max_partials sequences are being matched at the same time; when there are more, the oldest is dropped.
+    """
+    def __init__(self, steps: int, within: float, negated: bool = False, max_partials: int = seq_max_partials):
+        """
+        :param steps: Number of steps, the negated one included.
+        :param within: Seconds since the first step in which the sequence must happen.
+        :param negated: If the last step must not happen.
+        """
+        self.steps = steps
+        self.within = within
+        self.negated = negated
+        self.max_partials = max_partials
+        self._positives = steps - 1 if negated else steps
+        self._previous = None  # Result of the conditions in the previous evaluation
+        self._partials = deque()  # [start, index of the next step], oldest first
+        self._lock = threading.Lock()
+        self.matches = self.expired = self.cancelled = self.dropped = 0
+        _automata.add(self)
+
+    def feed(self, conditions, now=None):
+        """
+        :param conditions: Result of the condition of each step.
+        :param now: Timestamp of the evaluation (time.monotonic()), now by default.
+        :return: True if a sequence has matched with this evaluation.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            previous, self._previous = self._previous, [bool(c) for c in conditions]
+            if previous is None:  # Nothing happens in the first evaluation, the previous state is unknown
+                return False
+            happened = [c and not p for c, p in zip(self._previous, previous)]
+            matched = False
+            partials = deque()
+            for partial in self._partials:
+                start, index = partial
+                if now - start > self.within:
+                    if index == self._positives:  # Negated step not happened
+                        matched = True
+                        self.matches += 1
+                    else:
+                        self.expired += 1
+                elif index == self._positives:  # Waiting for the negated step
+                    if happened[-1]:
+                        self.cancelled += 1
+                    else:
+                        partials.append(partial)
+                elif happened[index]:
+                    partial[1] += 1
+                    if partial[1] == self._positives and not self.negated:
+                        matched = True
+                        self.matches += 1
+                    else:
+                        partials.append(partial)
+                else:
+                    partials.append(partial)
+            if happened[0]:
+                partials.append([now, 1])
+                if len(partials) > self.max_partials:
+                    partials.popleft()
+                    self.dropped += 1
+            self._partials = partials
+            return matched
+
+    def __len__(self):
+        return len(self._partials)
+
+    def stats(self):
+        return {
+            'partials': len(self), 'matches': self.matches, 'expired': self.expired, 'cancelled': self.cancelled,
+            'dropped': self.dropped
+        }
+
+
+def sequence_stats():
+    """
+    :return: The sum of the stats of every automaton alive.
+    """
+    automata = list(_automata)
+    the_stats = {'automata': len(automata), 'partials': 0, 'matches': 0, 'expired': 0, 'cancelled': 0, 'dropped': 0}
+    for automaton in automata:
+        for k, v in automaton.stats().items():
+            the_stats[k] += v
+    return the_stats
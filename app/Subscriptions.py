@@ -0,0 +1,151 @@
+import threading
+import time
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import Orion
+from Rules_db import RulesDB
+from config import CEP_MONGO_DB, subscription_refresh
+
+SUBSCRIBE_CLAIM = 30  # Seconds a worker has to subscribe to an entity before another one can do it
+
+
+class SubscriptionManager:
+    """
+    Shares the Orion subscriptions between the rules. There is one subscription per entity (and service and
+    servicepath) with every attribute any rule needs of it, and it is kept while some rule uses it.
+    The subscriptions and the rules that use them are stored in the database, so every worker sees the same ones.
+    """
+    instance = None
+
+    _subscriptions_db = RulesDB._client[CEP_MONGO_DB]['subscriptions']
+
+    def __new__(cls):
+        if cls.instance is None:
+            cls.instance = object.__new__(cls)
+            cls.instance._lock = threading.RLock()
+            cls.instance._rules = {}  # (service, servicepath, subsId) -> (expiration, [rule ids])
+            index_names = [idx['name'] for idx in cls._subscriptions_db.list_indexes()]
+            if not any('entity' in name for name in index_names):
+                cls._subscriptions_db.create_index(
+                    [('service', ASCENDING), ('servicepath', ASCENDING), ('entity', ASCENDING)], unique=True
+                )
+            if not any('subsId' in name for name in index_names):
+                cls._subscriptions_db.create_index('subsId')
+        return cls.instance
+
+    @staticmethod
+    def _headers(service, servicepath):
+        return {'Accept': 'application/json', 'Fiware-Service': service, 'Fiware-ServicePath': servicepath}
+
+    @staticmethod
+    def _description(entity_id):
+        return f'Cepheid subscription for the entity {entity_id}'
+
+    def _attach_entity(self, rule_id, service, servicepath, entity_id, entity_type, attrs):
+        key = {'service': service, 'servicepath': servicepath, 'entity': entity_id}
+        headers = self._headers(service, servicepath)
+        try:
+            before = self._subscriptions_db.find_one_and_update(
+                key,
+                {
+                    '$addToSet': {'rules': rule_id, 'attrs': {'$each': attrs}},
+                    '$setOnInsert': {'type': entity_type, 'subsId': None}
+                },
+                upsert=True, return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:  # Another worker has inserted it at the same time
+            return self._attach_entity(rule_id, service, servicepath, entity_id, entity_type, attrs)
+
+        if before is None or before['subsId'] is None:  # Not subscribed yet, or its subscription failed
+            self._subscribe_entity(key, headers)
+        elif before['subsId'] is not None and not set(attrs) <= set(before['attrs']):
+            doc = self._subscriptions_db.find_one(key)
+            Orion.update_subscription(
+                doc['subsId'], [{'id': entity_id, 'type': doc['type']}], sorted(doc['attrs']), headers,
+                self._description(entity_id)
+            )
+
+    def _subscribe_entity(self, key, headers):
+        """
+        Subscribes to an entity if no worker has done it yet. The worker that subscribes claims it for SUBSCRIBE_CLAIM
+        seconds, and the others wait for it: if it fails or dies, the next one subscribes.
+        :raise ConnectionError: If there is no subscription in the end.
+        """
+        deadline = time.monotonic() + 2 * SUBSCRIBE_CLAIM
+        while True:
+            now = time.time()
+            doc = self._subscriptions_db.find_one_and_update(
+                {**key, 'subsId': None, '$or': [{'subscribing': {'$exists': False}}, {'subscribing': {'$lt': now}}]},
+                {'$set': {'subscribing': now + SUBSCRIBE_CLAIM}}, return_document=ReturnDocument.AFTER
+            )
+            if doc is not None:  # Claimed by this worker
+                break
+            doc = self._subscriptions_db.find_one(key, {'subsId': True})
+            if doc is None or doc['subsId'] is not None:  # Subscribed by other worker, or no longer used
+                return
+            if time.monotonic() > deadline:
+                raise ConnectionError(f'The entity {key["entity"]} is still being subscribed by other worker.')
+            time.sleep(0.1)
+
+        entities = [{'id': key['entity'], 'type': doc['type']}]
+        try:
+            subs_id = Orion.subscribe(entities, sorted(doc['attrs']), headers, self._description(key['entity']))
+        except Exception:
+            self._subscriptions_db.update_one(key, {'$unset': {'subscribing': ''}})  # Other worker can try it
+            raise
+        after = self._subscriptions_db.find_one_and_update(
+            key, {'$set': {'subsId': subs_id}, '$unset': {'subscribing': ''}}, return_document=ReturnDocument.AFTER
+        )
+        if after is None:  # Every rule was detached meanwhile
+            Orion.unsubscribe(subs_id, headers)
+        elif set(after['attrs']) != set(doc['attrs']):  # Other rules were added meanwhile
+            Orion.update_subscription(subs_id, entities, sorted(after['attrs']), headers,
+                                      self._description(key['entity']))
+
+    def attach(self, rule_id, rule):
+        """
+        Subscribes a rule to its entities, sharing the subscriptions that already exist.
+        :param rule_id: The id of the rule in the database.
+        :param rule: The rule.
+        """
+        service, servicepath = rule.headers['Fiware-Service'], rule.headers['Fiware-ServicePath']
+        # Not locked: the updates of the database are atomic, so several rules can be attached at the same time
+        for entity_id, entity in rule.get_entities().items():
+            self._attach_entity(rule_id, service, servicepath, entity_id, entity['type'], entity['attrs'])
+        with self._lock:
+            self._rules.clear()
+
+    def detach(self, rule_id, service: str, servicepath: str):
+        """
+        Removes a rule from its subscriptions. The subscriptions no longer used are deleted from Orion.
+        """
+        with self._lock:
+            query = {'service': service, 'servicepath': servicepath, 'rules': rule_id}
+            ids = [doc['_id'] for doc in self._subscriptions_db.find(query, {'_id': True})]
+            self._subscriptions_db.update_many(query, {'$pull': {'rules': rule_id}})
+            for _id in ids:
+                unused = self._subscriptions_db.find_one_and_delete({'_id': _id, 'rules': {'$size': 0}})
+                if unused is not None and unused['subsId'] is not None:
+                    Orion.unsubscribe(unused['subsId'], self._headers(service, servicepath))
+            self._rules.clear()
+
+    def rules_of(self, service: str, servicepath: str, subscription_id):
+        """
+        Gets the rules that use a subscription. They are kept in memory for a while (CEP_SUBSCRIPTION_REFRESH seconds)
+        so the rules attached by other workers are eventually seen.
+        :return: The list of rule ids, or None if it is not a shared subscription.
+        """
+        key = (service, servicepath, subscription_id)
+        now = time.monotonic()
+        cached = self._rules.get(key)
+        if cached is None or cached[0] < now:
+            doc = self._subscriptions_db.find_one(
+                {'service': service, 'servicepath': servicepath, 'subsId': subscription_id}, {'rules': True}
+            )
+            if doc is None:
+                self._rules.pop(key, None)
+                return None
+            cached = self._rules[key] = (now + subscription_refresh, doc['rules'])
+        return cached[1]
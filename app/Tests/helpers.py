@@ -0,0 +1,15 @@
+from Rule import Rule
+
+svc = "orion"
+svcP = "/environment"
+
+
+def trusted_rule(text, service=svc, servicepath=svcP, **fields):
+    """
+    Builds a rule as if it came from the database, without asking Orion. Its entities are Room1 and Room2, of type Room.
+    :param fields: Other fields of the rule (i.e. every, on_change).
+    """
+    return Rule.from_dict({
+        'rule': text, 'service': service, 'servicepath': servicepath, 'subsId': None,
+        'entities': [{'id': 'Room1', 'type': 'Room'}, {'id': 'Room2', 'type': 'Room'}], **fields
+    }, trusted=True)
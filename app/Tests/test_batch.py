@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+from Batch import BatchEvaluator
+from Tests.helpers import trusted_rule
+
+
+class TestBatchEvaluator(unittest.TestCase):
+    def test_run(self):
+        rules = {
+            '1': trusted_rule('Room1.Temperature > 20'),
+            '2': trusted_rule('and(Room1.Temperature > 20, Room2.Temperature > 20)'),
+            '3': trusted_rule('Room1.Temperature > 20', 'other'),
+        }
+        queries = []
+
+        def query(entities, attrs, headers):
+            queries.append((headers['Fiware-Service'], entities, attrs))
+            return {'Room1': {'Temperature': 25}, 'Room2': {'Temperature': 15}}
+
+        with mock.patch('Orion.query', query):
+            stats = BatchEvaluator(4).run(rules, lambda rule_id, rule, context: rule.eval(context))
+
+        self.assertEqual(sorted(queries, key=lambda q: q[0]), [  # A single query per service and servicepath
+            ('orion', {'Room1': 'Room', 'Room2': 'Room'}, {'Temperature'}),
+            ('other', {'Room1': 'Room'}, {'Temperature'})
+        ])
+        self.assertEqual((stats['rules'], stats['tenants'], stats['true'], stats['false'], stats['errors']),
+                         (3, 2, 2, 1, 0))
+
+    def test_pool_kept(self):
+        evaluator = BatchEvaluator(2)
+        rules = {'1': trusted_rule('Room1.Temperature > 20')}
+        with mock.patch('Orion.query', lambda entities, attrs, headers: {'Room1': {'Temperature': 25}}):
+            evaluator.run(rules, lambda rule_id, rule, context: rule.eval(context))
+            pool = evaluator._pool.get()
+            stats = evaluator.run(rules, lambda rule_id, rule, context: rule.eval(context))
+        self.assertIs(evaluator._pool.get(), pool)  # Not created again on every run
+        self.assertEqual(stats['true'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -66,12 +66,42 @@ class TestRuleDB(unittest.TestCase):
         resp = requests.get(f'http://localhost:4013/rules', headers=headers)
         self.assertEqual(resp.status_code, 200)
 
+        resp = requests.get(f'http://localhost:4013/rules?limit=1&fields=rule&options=count', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), [{'id': rule_id, 'rule': r1.rule}])
+        self.assertGreaterEqual(int(resp.headers['Fiware-Total-Count']), 1)
+        resp = requests.get(f'http://localhost:4013/rules?after={rule_id}&fields=rule', headers=headers)
+        self.assertNotIn(rule_id, [rule['id'] for rule in resp.json()])
+        resp = requests.get(f'http://localhost:4013/rules?limit=-1', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+
         resp = requests.delete(f'http://localhost:4013/rules/{rule_id}', headers=headers)
         self.assertEqual(resp.status_code, 204)
 
         resp = requests.delete(f'http://localhost:4013/rules/{rule_id}', headers=headers)
         self.assertEqual(resp.status_code, 404)
 
+    def test_bulk(self):
+        rules = [
+            {'rule': 'Test01.Temperature > 30', 'true': 'Test01.AC_On'},
+            {'rule': 'Test01.Temperature > 30', 'true': 'Test01.AC_On'},
+            {'rule': 'Test01.Unknown > 30'}
+        ]
+        ndjson_headers = {**headers, 'Content-Type': 'application/x-ndjson'}
+        resp = requests.post(f'http://localhost:4013/rules/bulk', data='\n'.join(map(json.dumps, rules)) + '\nnot json',
+                             headers=ndjson_headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([r['status'] for r in resp.json()], [201, 409, 400, 400])
+        rule_id = resp.json()[0]['id']
+
+        resp = requests.get(f'http://localhost:4013/rules/export', headers=headers)
+        exported = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertIn('Test01.Temperature > 30', [rule['rule'] for rule in exported])
+        self.assertTrue(all('id' not in rule and 'subsId' not in rule for rule in exported))
+
+        resp = requests.delete(f'http://localhost:4013/rules/{rule_id}', headers=headers)
+        self.assertEqual(resp.status_code, 204)
+
 
 if __name__ == '__main__':
     unittest.main()
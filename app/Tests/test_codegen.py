@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+
+from Compiler import Lexer, Parser, compile_rule
+
+headers = {"Accept": "application/json", "Fiware-Service": "orion", "Fiware-ServicePath": "/environment"}
+
+
+class TestCodegen(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        lexer = Lexer()
+        parser = Parser()
+
+        def parse(rule):
+            return parser.parse(lexer.lex(rule), headers)
+
+        def compile_text(rule):
+            return compile_rule(parse(rule))
+
+        cls.parse = (parse, )  # If the function is assigned, the self is always passed as paremeters. We use a tuple.
+        cls.compile = (compile_text, )
+
+    def test_constant_folding(self):
+        compile_text = self.compile[0]
+
+        self.assertIn('return True', compile_text('1 >= 0.98').source)
+        self.assertIn('return False', compile_text('"a" = "b"').source)
+        self.assertIn('return True', compile_text('or(1 = 2, 2 = 2)').source)
+        self.assertIn('return False', compile_text('and(1 = 1, 2 < 1)').source)
+        self.assertEqual(compile_text('and(1 = 1, 10 > 2.5)').attributes, [])
+
+    def test_eval(self):
+        parse, compile_text = self.parse[0], self.compile[0]
+
+        for rule in ['1 >= 0.98', '5 <= 5.0', '"a" != "b"', 'or(1 = 2, 2 = 2)', 'and(1 = 1, 2 < 1)']:
+            self.assertEqual(compile_text(rule)({}), parse(rule).eval())
+
+    def test_plan(self):
+        tree = Parser().parse(
+            Lexer().lex('and(Room3.temp > 20, 1 = 1, Room3.mode = "auto")'), headers, {'Room3': 'Room'}
+        )
+        observed = compile_rule(tree, observe=True)
+        self.assertLess(observed.source.index("'temp'"), observed.source.index("'mode'"))  # Same cost, same order
+        for temperature in range(18, 30):
+            observed({'Room3': {'temp': temperature, 'mode': 'manual'}})
+
+        planned = compile_rule(tree)  # The mode decides more often
+        self.assertLess(planned.source.index("'mode'"), planned.source.index("'temp'"))
+        self.assertNotIn('observe', planned.source)
+        self.assertEqual([operand['expression'] for operand in tree.explain()['operands']], [
+            "(ctx['Room3']['mode'] == 'auto')", "(ctx['Room3']['temp'] > 20)"
+        ])
+        self.assertEqual(tree.explain()['operands'][1]['selectivity'], 0.75)
+
+    def test_reentrant_parse(self):
+        parser, lexer = Parser(), Lexer()
+
+        def parse(service):
+            tenant = {**headers, 'Fiware-Service': service}
+            tree = parser.parse(lexer.lex('and(Room4.temp > 20, or(Room4.hum < 50, Room4.co2 > 900))'), tenant,
+                                {'Room4': 'Room'})
+            return {predicate.left.headers['Fiware-Service'] for predicate in tree.predicates()}
+
+        services = [f'tenant{i % 8}' for i in range(200)]
+        with ThreadPoolExecutor(8) as pool:
+            self.assertEqual(list(pool.map(parse, services)), [{service} for service in services])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from Commands import CommandBatcher
+
+headers = {"Accept": "application/json", "Fiware-Service": "orion", "Fiware-ServicePath": "/environment"}
+other_headers = {"Accept": "application/json", "Fiware-Service": "orion", "Fiware-ServicePath": "/other"}
+
+
+class FakeBatcher(CommandBatcher):
+    def __init__(self, window, max_actions):
+        super().__init__(window, max_actions)
+        self.sent = []
+        self.posted = []  # The entities of each request, in order
+        self.done = threading.Event()
+
+    def _post(self, service, servicepath, entities):
+        self.sent.append((service, servicepath, sorted(e['id'] for e in entities)))
+        self.posted.append(entities)
+        self.done.set()
+
+
+def command(entity_id, cmd='AC_On'):
+    return {'type': 'TestEntity', 'id': entity_id, cmd: {'type': 'command', 'value': ''}}
+
+
+class TestCommandBatcher(unittest.TestCase):
+    def test_window(self):
+        batcher = FakeBatcher(window=0.05, max_actions=100)
+        batcher.send(headers, command('Test01'))
+        batcher.send(headers, command('Test02'))
+        batcher.send(headers, command('Test01'))  # Duplicated
+        batcher.send(other_headers, command('Test03'))
+        time.sleep(0.2)
+
+        self.assertEqual(sorted(batcher.sent), [
+            ('orion', '/environment', ['Test01', 'Test02']), ('orion', '/other', ['Test03'])
+        ])
+        self.assertEqual(batcher.stats()['duplicated'], 1)
+
+    def test_latest_last(self):
+        batcher = FakeBatcher(window=0.05, max_actions=100)
+        for cmd in ['AC_On', 'AC_Off', 'AC_On']:
+            batcher.send(headers, command('Test01', cmd))
+        self.assertTrue(batcher.done.wait(1))
+
+        commands = [next(k for k in entity if k not in ('id', 'type')) for entity in batcher.posted[0]]
+        self.assertEqual(commands, ['AC_Off', 'AC_On'])  # Orion applies them in order, AC_On is the latest decision
+
+    def test_max_actions(self):
+        batcher = FakeBatcher(window=10, max_actions=2)
+        batcher.send(headers, command('Test01'))
+        batcher.send(headers, command('Test02'))
+        self.assertTrue(batcher.done.wait(1))  # Sent without waiting for the window
+        self.assertEqual(batcher.sent, [('orion', '/environment', ['Test01', 'Test02'])])
+
+    def test_no_window(self):
+        batcher = FakeBatcher(window=0, max_actions=100)
+        batcher.send(headers, command('Test01'))
+        self.assertEqual(batcher.sent, [('orion', '/environment', ['Test01'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from Entity_cache import EntityCache, NotifiedValues
+
+svc = "orion"
+svcP = "/environment"
+
+
+class TestEntityCache(unittest.TestCase):
+    def test_lookup(self):
+        cache = EntityCache(ttl=10, max_size=10)
+        cache.update(svc, svcP, {'Room1': {'temp': 25, 'hum': 40}}, now=0)
+
+        self.assertEqual(cache.lookup(svc, svcP, [('Room1', 'temp'), ('Room1', 'co2')], now=5), {'Room1': {'temp': 25}})
+        self.assertEqual(cache.lookup('other', svcP, [('Room1', 'temp')], now=5), {})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_ttl(self):
+        cache = EntityCache(ttl=10, max_size=10)
+        cache.update(svc, svcP, {'Room1': {'temp': 25}}, now=0)
+        cache.update(svc, svcP, {'Room1': {'hum': 40}}, now=5)
+
+        self.assertEqual(cache.lookup(svc, svcP, [('Room1', 'temp'), ('Room1', 'hum')], now=12), {'Room1': {'hum': 40}})
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_lru(self):
+        cache = EntityCache(ttl=10, max_size=2)
+        cache.update(svc, svcP, {'Room1': {'temp': 25, 'hum': 40}}, now=0)
+        cache.lookup(svc, svcP, [('Room1', 'temp')], now=1)  # hum is now the least recently used
+        cache.update(svc, svcP, {'Room2': {'temp': 20}}, now=2)
+
+        self.assertEqual(cache.lookup(svc, svcP, [('Room1', 'temp'), ('Room1', 'hum')], now=3), {'Room1': {'temp': 25}})
+        self.assertEqual(cache.evictions, 1)
+
+    def test_changes(self):
+        cache = EntityCache(ttl=10, max_size=10)
+        self.assertEqual(cache.update(svc, svcP, {'Room1': {'temp': 25, 'hum': 40}}, now=0), [
+            ('Room1', 'temp'), ('Room1', 'hum')
+        ])
+        self.assertEqual(cache.update(svc, svcP, {'Room1': {'temp': 25, 'hum': 41}}, now=1), [('Room1', 'hum')])
+        self.assertEqual(cache.update(svc, svcP, {'Room1': {'temp': 25}}, now=20), [('Room1', 'temp')])  # Expired
+
+    def test_disabled(self):
+        cache = EntityCache(ttl=0, max_size=10)
+        cache.update(svc, svcP, {'Room1': {'temp': 25}}, now=0)
+        self.assertEqual(cache.lookup(svc, svcP, [('Room1', 'temp')], now=0), {})
+
+
+class TestNotifiedValues(unittest.TestCase):
+    def test_changes(self):
+        notified = NotifiedValues(max_size=10)
+        context = {'Room1': {'temp': 25, 'hum': 40}}
+        self.assertEqual(notified.changes(svc, svcP, context), [('Room1', 'temp'), ('Room1', 'hum')])
+        self.assertEqual(notified.changes(svc, svcP, context), [('Room1', 'temp'), ('Room1', 'hum')])  # Not stored
+        notified.commit(svc, svcP, context, {'Room1': {'temp': 't1'}})
+        self.assertEqual(notified.changes(svc, svcP, {'Room1': {'temp': 25, 'hum': 41}}), [('Room1', 'hum')])
+        # The same value modified again, i.e. notified to other worker in between
+        self.assertEqual(notified.changes(svc, svcP, context, {'Room1': {'temp': 't2'}}), [('Room1', 'temp')])
+
+    def test_not_hidden_by_reads(self):
+        cache, notified = EntityCache(ttl=10, max_size=10), NotifiedValues(max_size=10)
+        cache.update(svc, svcP, {'Room1': {'temp': 25}}, now=0)  # Read from Orion
+        self.assertEqual(notified.changes(svc, svcP, {'Room1': {'temp': 25}}), [('Room1', 'temp')])
+
+    def test_max_size(self):
+        notified = NotifiedValues(max_size=1)
+        notified.commit(svc, svcP, {'Room1': {'temp': 25}})
+        notified.commit(svc, svcP, {'Room2': {'temp': 25}})
+        self.assertEqual(len(notified), 1)
+        self.assertEqual(notified.changes(svc, svcP, {'Room1': {'temp': 25}}), [('Room1', 'temp')])
+
+
+if __name__ == '__main__':
+    unittest.main()
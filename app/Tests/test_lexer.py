@@ -15,6 +15,17 @@ class MyTestCase(unittest.TestCase):
         for recognized, spected in zip(tokens, spected_tokens):
             self.assertEqual(recognized.gettokentype(), spected)
 
+    def test_window_functions(self):
+        lexer = Lexer()
+        to_tokenize = 'AVG(Room1.temp, 5m) max (Room1.hum, 1.5h) count avg'
+        spected_tokens = [
+            'AVG', 'L_PAR', 'ID', 'DOT', 'ID', 'COMMA', 'DURATION', 'R_PAR', 'MAX', 'L_PAR', 'ID', 'DOT', 'ID', 'COMMA',
+            'DURATION', 'R_PAR', 'ID', 'ID'
+        ]
+        tokens = [token.gettokentype() for token in lexer.lex(to_tokenize)]
+
+        self.assertEqual(tokens, spected_tokens)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from Compiler import parse_cache
+from Compiler.Cache import ParseCache, normalize
+from Rule import Rule
+
+svc = "orion"
+svcP = "/environment"
+
+
+class FakeTree:
+    def get_entities(self):
+        return {}
+
+
+class TestParseCache(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(
+            normalize(' and( Room1.temp >  20 ,Room1.mode = "a  b" ) '), 'and(Room1.temp > 20,Room1.mode = "a  b")'
+        )
+
+    def test_lru(self):
+        cache = ParseCache(max_size=2)
+        for rule in ['1 = 1', '2 = 2', '3 = 3']:
+            cache.put(cache.key(rule, svc, svcP), FakeTree())
+        self.assertIsNone(cache.get(cache.key('1 = 1', svc, svcP)))
+        self.assertIsNotNone(cache.get(cache.key('3  =  3', svc, svcP)))
+        self.assertEqual((len(cache), cache.evictions, cache.hits, cache.misses), (2, 1, 1, 1))
+
+    def test_shared_by_rules(self):
+        stored = {
+            'rule': 'and(Room5.Temperature > 20, Room5.Mode = "auto")', 'service': svc, 'servicepath': svcP,
+            'subsId': None, 'entities': [{'id': 'Room5', 'type': 'Room'}]
+        }
+        first = Rule.from_dict(dict(stored), trusted=True)
+        hits = parse_cache.hits
+        second = Rule.from_dict({**stored, 'rule': 'and(Room5.Temperature > 20,  Room5.Mode = "auto")'}, trusted=True)
+
+        self.assertEqual(parse_cache.hits, hits + 1)
+        self.assertIs(first._rule, second._rule)
+        self.assertEqual(second.get_entities(), {'Room5': {'type': 'Room', 'attrs': ['Mode', 'Temperature']}})
+        other_type = Rule.from_dict({**stored, 'entities': [{'id': 'Room5', 'type': 'Office'}]}, trusted=True)
+        self.assertEqual(other_type.get_entities()['Room5']['type'], 'Office')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import json
 from datetime import datetime, time
 
@@ -112,5 +113,107 @@ class TestParser(unittest.TestCase):
         self.assertIsNone(rule.unsubscribe())
 
 
+class TestTrustedRule(unittest.TestCase):
+    def test_from_dict_trusted(self):
+        stored = {
+            'rule': 'and(Room1.Temperature > 20, Room1.Mode = "auto")', 'service': svc, 'servicepath': svcP,
+            'subsId': None, 'true': 'Room1.AC_On', 'true_type': 'Room',
+            'entities': [{'id': 'Room1', 'type': 'Room'}]
+        }
+        rule = Rule.from_dict(dict(stored), trusted=True)  # Orion is never asked
+        self.assertEqual(rule.get_entities(), {'Room1': {'type': 'Room', 'attrs': ['Mode', 'Temperature']}})
+        self.assertTrue(rule.eval({'Room1': {'Temperature': 25, 'Mode': 'auto'}}))
+        self.assertFalse(rule.eval({'Room1': {'Temperature': 15, 'Mode': 'auto'}}))
+        self.assertEqual(rule.to_dict()['entities'], [{'id': 'Room1', 'type': 'Room', 'attrs': ['Mode', 'Temperature']}])
+        self.assertEqual(Rule.from_dict(rule.to_dict(), trusted=True), rule)
+
+    @staticmethod
+    def on_change_rule():
+        return Rule.from_dict({
+            'rule': 'Room1.Temperature > 20', 'service': svc, 'servicepath': svcP, 'subsId': None,
+            'true': 'Room1.On', 'true_type': 'Room', 'false': 'Room1.Off', 'false_type': 'Room',
+            'entities': [{'id': 'Room1', 'type': 'Room'}], 'on_change': True
+        }, trusted=True)
+
+    def test_on_change(self):
+        rule = self.on_change_rule()
+        sent = []
+        with mock.patch('Rule.command_batcher') as batcher:
+            batcher.send.side_effect = lambda headers, command: sent.append(next(k for k in command if k[0].isupper()))
+            for temperature in [25, 26, 15, 10, 30]:
+                rule.execute({'Room1': {'Temperature': temperature}})
+        self.assertEqual(sent, ['On', 'Off', 'On'])
+        self.assertTrue(rule.last_result)
+        with self.assertRaises(ValueError):
+            rule.set_on_change('yes')
+
+    def test_on_change_workers(self):
+        stored = {}  # As RulesDB.save_state
+
+        def save_state(result):
+            changed = stored.get('last_result') != result
+            stored['last_result'] = result
+            return changed
+
+        worker_a, worker_b = self.on_change_rule(), self.on_change_rule()  # The same rule in two workers
+        sent = []
+        with mock.patch('Rule.command_batcher') as batcher:
+            batcher.send.side_effect = lambda headers, command: sent.append(next(k for k in command if k[0].isupper()))
+            for worker, temperature in [(worker_a, 10), (worker_b, 30), (worker_a, 30), (worker_b, 10),
+                                        (worker_a, 25), (worker_b, 25)]:
+                worker.execute({'Room1': {'Temperature': temperature}}, checkpoint=save_state)
+        # worker_a still has True when 25 arrives, but the stored result is False
+        self.assertEqual(sent, ['Off', 'On', 'Off', 'On'])
+
+    def test_content_hash(self):
+        stored = {
+            'rule': 'and(Room1.Temperature > 20, Room1.Mode = "auto")', 'service': svc, 'servicepath': svcP,
+            'subsId': None, 'entities': [{'id': 'Room1', 'type': 'Room'}]
+        }
+        rule = Rule.from_dict(dict(stored), trusted=True)
+        same = Rule.from_dict({**stored, 'rule': 'and(Room1.Temperature > 20,Room1.Mode = "auto")', 'subsId': 'x'},
+                              trusted=True)
+        other = Rule.from_dict(dict(stored), trusted=True).set_on_change(True)
+
+        self.assertEqual(Rule.content_hash(rule.to_dict()), Rule.content_hash(same.to_dict()))
+        self.assertNotEqual(Rule.content_hash(rule.to_dict()), Rule.content_hash(other.to_dict()))
+
+    def test_lazy_fetch(self):
+        rule = Rule.from_dict({
+            'rule': 'or(Room1.Temperature > 20, Room2.Temperature > 20)', 'service': svc, 'servicepath': svcP,
+            'subsId': None, 'entities': [{'id': 'Room1', 'type': 'Room'}, {'id': 'Room2', 'type': 'Room'}]
+        }, trusted=True)
+        self.assertTrue(rule.eval({'Room1': {'Temperature': 25}}))  # Decided without asking Orion for Room2
+        self.assertEqual(rule.explain()['evaluations'], 1)
+
+    def test_build_modified(self):
+        data = [{
+            'id': 'Room1', 'type': 'Room',
+            'temp': {'type': 'Number', 'value': 25, 'metadata': {'dateModified': {'type': 'DateTime', 'value': 't1'}}},
+            'hum': {'type': 'Number', 'value': 40, 'metadata': {'TimeInstant': {'type': 'DateTime', 'value': 't2'}}},
+            'co2': {'type': 'Number', 'value': 400, 'metadata': {}}
+        }, {'id': 'Room2', 'type': 'Room', 'temp': 20}]
+        self.assertEqual(Rule.build_modified(data), {'Room1': {'temp': 't1', 'hum': 't2'}})
+
+    def test_activity(self):
+        rule = Rule.from_dict({
+            'rule': 'Room1.Temperature > 20', 'service': svc, 'servicepath': svcP, 'subsId': None,
+            'entities': [{'id': 'Room1', 'type': 'Room'}], 'date_from': '01/01/2021', 'start_time': '22:30',
+            'end_time': '08:00'
+        }, trusted=True)
+        self.assertEqual(rule.activity(datetime(2020, 12, 31, 23, 0)), (False, datetime(2021, 1, 1)))
+        self.assertEqual(rule.activity(datetime(2021, 1, 1)), (True, datetime(2021, 1, 1, 8, 0, 0, 1)))
+        self.assertEqual(rule.activity(datetime(2021, 1, 1, 12, 0)), (False, datetime(2021, 1, 1, 22, 30)))
+        self.assertEqual(rule.activity(datetime(2021, 1, 1, 23, 0)), (True, datetime(2021, 1, 2, 8, 0, 0, 1)))
+
+        rule = Rule.from_dict({
+            'rule': 'Room1.Temperature > 20', 'service': svc, 'servicepath': svcP, 'subsId': None,
+            'entities': [{'id': 'Room1', 'type': 'Room'}]
+        }, trusted=True)
+        self.assertTrue(rule.can_execute())
+        rule.set_date_to('01/01/2021')
+        self.assertFalse(rule.can_execute())  # The window kept is discarded
+
+
 if __name__ == '__main__':
     unittest.main()
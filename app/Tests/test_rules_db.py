@@ -2,6 +2,7 @@ import unittest
 import json
 
 import requests
+from pymongo.errors import DuplicateKeyError
 
 from config import orion_url, iota_url, default_service, default_servicepath
 from Rule import Rule
@@ -61,6 +62,7 @@ class TestRuleDB(unittest.TestCase):
         self.id_r1 = self.rdb.insert(self.r1)
         self.assertIsInstance(self.id_r1, str)
         self.assertIn(self.r1, self.rdb)
+        self.assertRaises(DuplicateKeyError, self.rdb.insert, self.r1)
         self.assertIsInstance(self.rdb.insert(self.r2), str)
         self.assertIn(self.r2, self.rdb)
 
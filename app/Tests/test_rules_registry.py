@@ -0,0 +1,74 @@
+from datetime import datetime
+import unittest
+from unittest import mock
+
+from Rules_registry import RulesRegistry
+from Tests.helpers import trusted_rule
+
+
+class TestSharedPredicates(unittest.TestCase):
+    def setUp(self):
+        RulesRegistry.instance = None
+        self.registry = RulesRegistry(None, None)
+
+    def tearDown(self):
+        RulesRegistry.instance = None
+
+    def test_share(self):
+        hot = trusted_rule('Room1.Temperature > 20')
+        hot_auto = trusted_rule('and(Room1.Temperature > 20, Room1.Mode = "auto")')
+        self.registry.add('1', hot)
+        self.assertNotIn('memo[', hot._evaluator.source)
+        self.registry.add('2', hot_auto)
+        self.assertEqual(self.registry.predicate_stats(), {'distinct': 2, 'shared': 1, 'references': 3})
+
+        memo = {}
+        self.assertTrue(hot.eval({'Room1': {'Temperature': 25}}, memo))
+        # The comparison is taken from the memo of the event, not evaluated again
+        self.assertTrue(hot_auto.eval({'Room1': {'Temperature': 10, 'Mode': 'auto'}}, memo))
+        self.assertFalse(hot_auto.eval({'Room1': {'Temperature': 10, 'Mode': 'auto'}}))
+
+        self.registry.remove('1')
+        self.assertNotIn('memo[', hot_auto._evaluator.source)
+        self.assertEqual(self.registry.predicate_stats(), {'distinct': 2, 'shared': 0, 'references': 2})
+
+
+class TestActivity(unittest.TestCase):
+    def setUp(self):
+        RulesRegistry.instance = None
+        self.registry = RulesRegistry(None, None)
+
+    def tearDown(self):
+        RulesRegistry.instance = None
+
+    def at(self, *args):
+        now = mock.patch('Rules_registry.datetime')
+        now.start().now.return_value = datetime(*args)
+        self.addCleanup(now.stop)
+
+    def test_schedule(self):
+        self.at(2021, 3, 1, 7, 0)
+        self.registry.add('1', trusted_rule('Room1.Temperature > 20').set_schedule('08:00', '20:00'))
+        self.registry.add('2', trusted_rule('Room1.Temperature > 30'))
+        self.assertEqual(list(self.registry.rules(['1', '2'])), ['2'])
+        self.assertEqual(self.registry.activity_stats(),
+                         {'active': 1, 'inactive': 1, 'next_change': '2021-03-01T08:00:00'})
+        self.at(2021, 3, 1, 8, 0)
+        self.assertTrue(self.registry.is_active('1'))
+        self.at(2021, 3, 1, 20, 1)
+        self.assertFalse(self.registry.is_active('1'))
+        self.assertEqual(self.registry.activity_stats()['next_change'], '2021-03-02T08:00:00')
+
+    def test_dates(self):
+        self.at(2021, 3, 1)
+        self.registry.add('1', trusted_rule('Room1.Temperature > 20').set_date_to('01/03/2021'))
+        self.assertTrue(self.registry.is_active('1'))
+        self.at(2021, 3, 2)
+        self.assertFalse(self.registry.is_active('1'))
+        self.assertEqual(self.registry.activity_stats(), {'active': 0, 'inactive': 1, 'next_change': None})
+        self.registry.remove('1')
+        self.assertEqual(self.registry.activity_stats(), {'active': 0, 'inactive': 0, 'next_change': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
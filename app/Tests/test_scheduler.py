@@ -0,0 +1,113 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from Rule import Rule
+from Scheduler import RuleScheduler
+from Tests.helpers import trusted_rule
+
+
+class TestRuleScheduler(unittest.TestCase):
+    def test_pop_due(self):
+        scheduler = RuleScheduler(0.1, run=None)
+        scheduler.schedule('a', 10, now=0)
+        scheduler.schedule('b', 10, now=0)
+        self.assertEqual(scheduler._pop_due(-1), [])
+        self.assertEqual(sorted(scheduler._pop_due(10)), ['a', 'b'])  # The first run is within the first period
+        self.assertEqual(scheduler._pop_due(10), [])
+        self.assertEqual(sorted(scheduler._pop_due(20)), ['a', 'b'])
+
+    def test_coalesce(self):
+        scheduler = RuleScheduler(1, run=None)
+        scheduler._push('a', 10, 60)
+        scheduler._push('b', 10.5, 60)
+        scheduler._push('c', 12, 60)
+        self.assertEqual(scheduler._pop_due(10), ['a', 'b'])  # Within the same tick
+
+    def test_missed(self):
+        scheduler = RuleScheduler(0.1, run=None)
+        scheduler._push('a', 10, 10)
+        self.assertEqual(scheduler._pop_due(45), ['a'])  # Run once, not once per missed period
+        self.assertEqual(scheduler.missed, 3)
+        self.assertEqual(scheduler._heap[0][0], 50)  # Keeps its phase
+        self.assertEqual(scheduler._pop_due(46), [])
+
+    def test_shorter_than_tick(self):
+        scheduler = RuleScheduler(1, run=None)
+        scheduler._push('a', 10, 0.3)
+        self.assertEqual(scheduler._pop_due(10), ['a'])  # Once per batch
+        self.assertAlmostEqual(scheduler._heap[0][0], 11.2)
+
+    def test_unschedule(self):
+        scheduler = RuleScheduler(0.1, run=None)
+        scheduler._push('a', 10, 10)
+        scheduler._push('b', 10, 10)
+        scheduler.unschedule('a')
+        scheduler.schedule('b', 100, now=20)  # Replaces its previous schedule
+        self.assertEqual(scheduler._pop_due(15), [])
+        self.assertEqual(scheduler.scheduled(), ['b'])
+
+    def test_run(self):
+        batches = []
+        done = threading.Event()
+
+        def run(rule_ids):
+            batches.append(sorted(rule_ids))
+            if len(batches) == 2:
+                done.set()
+
+        scheduler = RuleScheduler(0.05, run)
+        scheduler._push('a', time.monotonic() + 0.05, 0.1)
+        scheduler._push('b', time.monotonic() + 0.06, 0.1)
+        scheduler.start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(batches, [['a', 'b'], ['a', 'b']])
+
+    def test_start_after_fork(self):
+        scheduler = RuleScheduler(0.05, run=None)
+        with mock.patch('os.register_at_fork') as register_at_fork:
+            scheduler.start_after_fork()
+        register_at_fork.assert_called_once_with(after_in_child=scheduler._forked)
+        self.assertFalse(scheduler._thread.created())  # Not started in this process
+
+    def test_not_leader(self):
+        ran = []
+        scheduler = RuleScheduler(0.05, ran.append, is_leader=lambda: False)
+        scheduler._push('a', time.monotonic(), 0.01)
+        scheduler.start()
+        time.sleep(0.1)
+        self.assertEqual(ran, [])
+        self.assertEqual(scheduler.runs, 0)
+
+
+class TestEvery(unittest.TestCase):
+    def rule(self, **fields):
+        return trusted_rule('Room1.Temperature > 20', **fields)
+
+    def test_every(self):
+        rule = self.rule(every='5m')
+        self.assertEqual(rule.every, 300)
+        self.assertEqual(rule.to_dict()['every'], '5m')
+        self.assertIsNone(self.rule().every)
+        self.assertNotIn('every', self.rule().to_dict())
+        for every in ['5', 'often', 5, '0s']:
+            with self.assertRaises(ValueError):
+                self.rule(every=every)
+
+    def test_round_trip(self):
+        rule = self.rule(every='14d')
+        stored = rule.to_dict()
+        self.assertEqual(stored['every'], '14d')
+        self.assertEqual(Rule.from_dict(dict(stored), trusted=True).every, 14 * 86400)
+        Rule.content_hash(stored)  # Does not raise
+
+    def test_content_hash(self):
+        without = self.rule().to_dict()
+        self.assertNotEqual(Rule.content_hash(self.rule(every='30s').to_dict()), Rule.content_hash(without))
+        self.assertEqual(Rule.content_hash(self.rule(every='1m').to_dict()),
+                         Rule.content_hash(self.rule(every='60s').to_dict()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+
+from Compiler import Lexer, Parser, compile_rule
+from Sequences import SequenceAutomaton
+
+headers = {"Accept": "application/json", "Fiware-Service": "orion", "Fiware-ServicePath": "/environment"}
+types = {'Door1': 'Door', 'Room1': 'Room', 'Alarm1': 'Alarm'}
+
+
+class TestSequences(unittest.TestCase):
+    def test_sequence(self):
+        automaton = SequenceAutomaton(2, within=10)
+        events = [(0, (False, False)), (1, (True, False)), (2, (True, False)), (3, (True, True))]
+        self.assertEqual([automaton.feed(conditions, now=ts) for ts, conditions in events], [False] * 3 + [True])
+        self.assertEqual(automaton.stats(), {'partials': 0, 'matches': 1, 'expired': 0, 'cancelled': 0, 'dropped': 0})
+
+    def test_edges(self):
+        automaton = SequenceAutomaton(2, within=10)
+        automaton.feed((True, True), now=0)  # The first evaluation does not start a sequence
+        self.assertFalse(automaton.feed((False, True), now=1))
+        self.assertFalse(automaton.feed((True, True), now=2))  # The second step is still true, it does not happen
+        self.assertFalse(automaton.feed((True, False), now=3))
+        self.assertTrue(automaton.feed((True, True), now=4))
+
+    def test_within(self):
+        automaton = SequenceAutomaton(2, within=10)
+        automaton.feed((False, False), now=0)
+        automaton.feed((True, False), now=1)
+        self.assertFalse(automaton.feed((True, True), now=12))
+        self.assertEqual((automaton.expired, len(automaton)), (1, 0))
+
+    def test_negated(self):
+        automaton = SequenceAutomaton(2, within=10, negated=True)
+        automaton.feed((False, False), now=0)
+        automaton.feed((True, False), now=1)
+        self.assertFalse(automaton.feed((False, False), now=5))
+        self.assertTrue(automaton.feed((False, False), now=12))  # The second step has not happened within 10s
+
+        automaton.feed((True, False), now=13)
+        self.assertFalse(automaton.feed((True, True), now=15))
+        self.assertFalse(automaton.feed((False, False), now=30))
+        self.assertEqual((automaton.matches, automaton.cancelled), (1, 1))
+
+    def test_max_partials(self):
+        automaton = SequenceAutomaton(2, within=100, max_partials=2)
+        automaton.feed((False, False), now=0)
+        for ts in range(1, 7):
+            automaton.feed((ts % 2 == 1, False), now=ts)
+        self.assertEqual((len(automaton), automaton.dropped), (2, 1))
+
+    def test_rule(self):
+        parser, lexer = Parser(), Lexer()
+        tree = parser.parse(
+            lexer.lex('SEQ(Door1.state = "open", Room1.motion = 1, NOT Alarm1.on = 1, WITHIN 30s)'), headers, types
+        )
+        evaluator = compile_rule(tree)
+
+        self.assertEqual(len(evaluator.automata), 1)
+        self.assertEqual(compile_rule(tree, automata=evaluator.automata).automata, evaluator.automata)
+        self.assertEqual(set(tree.get_entities()), {'Door1', 'Room1', 'Alarm1'})
+        self.assertFalse(evaluator({'Door1': {'state': 'closed'}, 'Room1': {'motion': 0}, 'Alarm1': {'on': 0}}))
+        wrong_rules = [
+            'SEQ(Door1.state = "open", WITHIN 30s)', 'SEQ(NOT Door1.state = "open", Room1.motion = 1, WITHIN 1m)'
+        ]
+        for wrong in wrong_rules:
+            self.assertRaises(ValueError, parser.parse, lexer.lex(wrong), headers, types)
+
+    def test_single_process(self):
+        with mock.patch('Process.worker_processes', return_value=4):
+            with self.assertRaises(ValueError):
+                Parser().parse(Lexer().lex('SEQ(Door1.state = "open", Room1.motion = 1, WITHIN 30s)'), headers, types)
+
+
+if __name__ == '__main__':
+    unittest.main()
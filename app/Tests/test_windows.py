@@ -0,0 +1,84 @@
+import gc
+import math
+import unittest
+from unittest import mock
+
+from Compiler import Lexer, Parser, compile_rule
+from Windows import WindowStore, Avg, Max, Min, Count, Rate, parse_duration, window_store
+
+svc = "orion"
+svcP = "/environment"
+headers = {"Accept": "application/json", "Fiware-Service": svc, "Fiware-ServicePath": svcP}
+
+
+class TestWindows(unittest.TestCase):
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('30s'), 30)
+        self.assertEqual(parse_duration('1.5m'), 90)
+        self.assertEqual(parse_duration('2h'), 7200)
+        self.assertRaises(ValueError, parse_duration, '10')
+
+    def test_aggregators(self):
+        aggregators = [Avg(10, 100), Max(10, 100), Min(10, 100), Count(10, 100), Rate(10, 100)]
+        for ts, value in [(0, 20), (4, 30), (8, 10), (12, 16)]:
+            for aggregator in aggregators:
+                aggregator.push(ts, value)
+
+        # The sample of 0 is out of the window at 12
+        self.assertEqual([a.value(now=12) for a in aggregators], [56 / 3, 30, 10, 3, -14 / 8])
+        # Only the sample of 12 at 20
+        self.assertEqual([a.value(now=20) for a in aggregators], [16, 16, 16, 1, 0.0])
+        self.assertTrue(math.isnan(aggregators[0].value(now=30)))
+        self.assertEqual(aggregators[3].value(now=30), 0)
+
+    def test_max_samples(self):
+        maximum = Max(10, 2)
+        for ts, value in enumerate([30, 20, 10]):
+            maximum.push(ts, value)
+        self.assertEqual((maximum.value(now=3), len(maximum)), (20, 2))
+
+    def test_feed(self):
+        store = WindowStore(100)
+        average = store.register(svc, svcP, 'Room1', 'temp', 'AVG', 60)
+        count = store.register(svc, svcP, 'Room1', 'temp', 'COUNT', 60)
+        self.assertIs(store.register(svc, svcP, 'Room1', 'temp', 'AVG', 60), average)
+
+        fed = store.feed(svc, svcP, {'Room1': {'temp': 'error', 'hum': 40}}, now=0)
+        store.feed(svc, svcP, {'Room1': {'temp': 20}}, now=1)
+        self.assertEqual(fed, [('Room1', 'temp')])
+        self.assertEqual((average.value(now=2), count.value(now=2)), (20, 2))  # Only numbers are averaged
+        self.assertEqual(store.stats(), {'aggregators': 2, 'samples': 3})
+
+        fed = store.feed(svc, svcP, {'Room1': {'temp': 20, 'hum': 41}}, changed=[('Room1', 'hum')], now=2)
+        self.assertEqual((fed, count.value(now=2)), ([], 2))  # temp is not a new sample
+
+    def test_rule(self):
+        tree = Parser().parse(
+            Lexer().lex('and(AVG(Room2.temp, 5m) > 20, max(Room2.temp, 30s) < 40)'), headers, {'Room2': 'Room'}
+        )
+        evaluator = compile_rule(tree)
+
+        self.assertEqual(tree.get_entities(), {'Room2': {'type': 'Room', 'attrs': {'temp'}}})
+        self.assertFalse(evaluator({}))  # No samples
+        window_store.feed(svc, svcP, {'Room2': {'temp': 25}})
+        self.assertTrue(evaluator({}))
+        window_store.feed(svc, svcP, {'Room2': {'temp': 45}})
+        self.assertFalse(evaluator({}))
+
+    def test_released(self):
+        store = WindowStore(100)
+        count = store.register(svc, svcP, 'Room1', 'temp', 'COUNT', 60)
+        self.assertEqual(store.feed(svc, svcP, {'Room1': {'temp': 20}}), [('Room1', 'temp')])
+        del count  # No rule uses it
+        gc.collect()
+        self.assertEqual(store.feed(svc, svcP, {'Room1': {'temp': 21}}), [])
+        self.assertEqual(store.stats(), {'aggregators': 0, 'samples': 0})
+
+    def test_single_process(self):
+        with mock.patch('Process.worker_processes', return_value=4):
+            with self.assertRaises(ValueError):
+                Parser().parse(Lexer().lex('AVG(Room2.temp, 5m) > 20'), headers, {'Room2': 'Room'})
+
+
+if __name__ == '__main__':
+    unittest.main()
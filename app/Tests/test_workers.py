@@ -0,0 +1,63 @@
+import queue
+import threading
+import unittest
+
+from Workers import NotificationWorkers
+
+
+class TestWorkers(unittest.TestCase):
+    def test_order(self):
+        workers = NotificationWorkers(workers=3, queue_size=100)
+        done = {'a': [], 'b': []}
+        for n in range(50):
+            for key in done:
+                workers.submit(key, lambda key=key, n=n: done[key].append(n))
+        workers.join()
+
+        self.assertEqual(done, {'a': list(range(50)), 'b': list(range(50))})
+        self.assertEqual(workers.stats()['processed'], 100)
+
+    def test_backpressure(self):
+        workers = NotificationWorkers(workers=1, queue_size=1)
+        started, release = threading.Event(), threading.Event()
+        workers.submit('a', lambda: (started.set(), release.wait()))
+        started.wait()
+        workers.submit('a', lambda: None)  # Waiting in the queue
+
+        with self.assertRaises(queue.Full):
+            workers.submit('a', lambda: None)
+        release.set()
+        workers.join()
+        self.assertEqual(workers.stats()['rejected'], 1)
+
+    def test_all_or_none(self):
+        workers = NotificationWorkers(workers=2, queue_size=1)
+        started, release = threading.Event(), threading.Event()
+        key = next(key for key in 'abcdefgh' if hash(key) % 2 != hash('a') % 2)  # Other worker than 'a'
+        workers.submit('a', lambda: (started.set(), release.wait()))
+        started.wait()
+        workers.submit('a', lambda: None)  # The queue of 'a' is full
+        done = []
+
+        with self.assertRaises(queue.Full):
+            workers.submit_all([(key, lambda: done.append(key)), ('a', lambda: done.append('a'))])
+        release.set()
+        workers.join()
+        self.assertEqual(done, [])  # Not even the task with room was run
+        self.assertEqual(workers.stats()['rejected'], 2)
+
+    def test_accepted(self):
+        workers = NotificationWorkers(workers=1, queue_size=10)
+        done = []
+        workers.submit_all([('a', lambda: done.append('task'))], accepted=lambda: done.append('accepted'))
+        workers.join()
+        self.assertEqual(done, ['accepted', 'task'])
+
+    def test_errors(self):
+        workers = NotificationWorkers(workers=0, queue_size=1)
+        workers.submit('a', lambda: 1 / 0)  # Run in this thread, the error is not propagated
+        self.assertEqual(workers.stats()['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+from collections import deque
+import math
+import operator
+import re
+import threading
+import time
+import weakref
+
+from config import window_max_samples
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(duration: str):
+    """
+    :param duration: Duration in the format <number><unit>, with unit s, m, h or d (i.e. 30s, 5m).
+    :return: The duration in seconds.
+    """
+    groups = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', duration)
+    if groups is None:
+        raise ValueError(f'The duration "{duration}" must be a number followed by s, m, h or d.')
+    return float(groups.group(1)) * UNITS[groups.group(2)]
+
+
+class Aggregator:
+    """
+    Aggregate of the samples of an attribute within a sliding window of time, updated incrementally.
+    At most max_samples are kept.
+    """
+    numeric = True  # Only numeric samples are aggregated
+
+    def __init__(self, window: float, max_samples: int):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples = deque()  # (timestamp, sequence number, value)
+        self._pushed = 0
+        self._lock = threading.Lock()
+
+    def push(self, timestamp, value):
+        with self._lock:
+            self._pushed += 1
+            self._samples.append((timestamp, self._pushed, value))
+            self._added(self._pushed, value)
+            if len(self._samples) > self.max_samples:
+                self._removed(*self._samples.popleft()[1:])
+
+    def _evict(self, now):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._removed(*self._samples.popleft()[1:])
+
+    def _added(self, seq, value):
+        pass
+
+    def _removed(self, seq, value):
+        pass
+
+    def value(self, now=None):
+        with self._lock:
+            self._evict(time.monotonic() if now is None else now)
+            return self._result() if self._samples else self._empty()
+
+    def _empty(self):
+        return math.nan  # Every comparison with it is false
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class Avg(Aggregator):
+    def __init__(self, window, max_samples):
+        super().__init__(window, max_samples)
+        self._sum = 0
+
+    def _added(self, seq, value):
+        self._sum += value
+
+    def _removed(self, seq, value):
+        self._sum -= value
+
+    def _result(self):
+        return self._sum / len(self._samples)
+
+
+class Count(Aggregator):
+    numeric = False
+
+    def _result(self):
+        return len(self._samples)
+
+    def _empty(self):
+        return 0
+
+
+class Rate(Aggregator):
+    def _result(self):
+        (first_ts, _, first), (last_ts, _, last) = self._samples[0], self._samples[-1]
+        return (last - first) / (last_ts - first_ts) if last_ts > first_ts else 0.0
+
+
+class Extreme(Aggregator):
+    """
+    Max. or min. with a monotonic queue: only the samples that can still be the extreme are kept in it.
+    """
+    better = None  # operator that is true if the first value is a better extreme than the second
+
+    def __init__(self, window, max_samples):
+        super().__init__(window, max_samples)
+        self._candidates = deque()  # (sequence number, value)
+
+    def _added(self, seq, value):
+        while self._candidates and not self.better(self._candidates[-1][1], value):
+            self._candidates.pop()
+        self._candidates.append((seq, value))
+
+    def _removed(self, seq, value):
+        if self._candidates and self._candidates[0][0] == seq:
+            self._candidates.popleft()
+
+    def _result(self):
+        return self._candidates[0][1]
+
+
+class Max(Extreme):
+    better = staticmethod(operator.gt)
+
+
+class Min(Extreme):
+    better = staticmethod(operator.lt)
+
+
+class WindowStore:
+    """
+    Aggregators of the attributes used in the window functions of the rules, fed by the notifications. They are kept
+    while some rule (or parsed rule in the cache) uses them, then they are no longer fed.
+    """
+    aggregators = {'AVG': Avg, 'MAX': Max, 'MIN': Min, 'COUNT': Count, 'RATE': Rate}
+
+    def __init__(self, max_samples: int):
+        self.max_samples = max_samples
+        # (service, servicepath, entity_id, attr) -> {(function, window): Aggregator}, weak: the rules keep them alive
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def register(self, service: str, servicepath: str, entity_id: str, attr: str, function: str, window: float):
+        """
+        Gets the aggregator of a window function of an attribute, creating it if it does not exist.
+        :param function: AVG, MAX, MIN, COUNT or RATE.
+        :param window: Seconds of the window.
+        """
+        with self._lock:
+            series = self._series.setdefault((service, servicepath, entity_id, attr), weakref.WeakValueDictionary())
+            aggregator = series.get((function, window))
+            if aggregator is None:
+                aggregator = series[(function, window)] = self.aggregators[function](window, self.max_samples)
+            return aggregator
+
+    def feed(self, service: str, servicepath: str, context: dict, changed=None, now=None):
+        """
+        Adds the values of a context to the aggregators of their attributes.
+        :param context: Dict in the format {entity_id: {attr: value}}.
+        :param changed: Iterable of (entity_id, attr), the only ones added if informed. A notification has every
+        attribute of the entity used by the rules, so the ones it has not changed are not new samples.
+        :return: List of (entity_id, attr) with some aggregator.
+        """
+        changed = None if changed is None else set(changed)
+        fed = []
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for entity_id, attrs in context.items():
+                for attr, value in attrs.items():
+                    key = (service, servicepath, entity_id, attr)
+                    series = self._series.get(key)
+                    if series is not None and not series:  # Its rules no longer exist
+                        del self._series[key]
+                    if not series or (changed is not None and (entity_id, attr) not in changed):
+                        continue
+                    fed.append((entity_id, attr))
+                    is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                    for aggregator in list(series.values()):
+                        if is_number or not aggregator.numeric:
+                            aggregator.push(now, value)
+        return fed
+
+    def stats(self):
+        aggregators = [a for series in list(self._series.values()) for a in list(series.values())]
+        return {'aggregators': len(aggregators), 'samples': sum(len(a) for a in aggregators)}
+
+
+window_store = WindowStore(window_max_samples)
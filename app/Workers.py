@@ -0,0 +1,94 @@
+import logging
+import queue
+import threading
+
+from Process import PerProcess, start_thread
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationWorkers:
+    """
+    Pool of threads that process the notifications out of the request. Each worker has its own bounded queue and the
+    tasks of the same key (i.e. the same rule) always go to the same worker, so they are run in order.
+    With 0 workers, the tasks are run in the thread that submits them.
+    """
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = []
+        self._started = PerProcess(self._start)
+        self._submit_lock = threading.Lock()  # Only the workers take tasks while it is held, so room is not lost
+        self.processed = self.rejected = self.errors = 0
+
+    def _start(self):
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        for n, tasks in enumerate(self._queues):
+            start_thread(self._work, f'cepheid-worker-{n}', tasks)
+        return self._queues
+
+    def _run(self, task):
+        try:
+            task()
+        except Exception as e:
+            self.errors += 1
+            logger.error(f'Error processing a notification: {e}')
+        self.processed += 1
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            self._run(task)
+            tasks.task_done()
+
+    def submit(self, key, task):
+        """
+        Enqueues a task.
+        :param key: Tasks with the same key are run in the same order they are submitted.
+        :param task: Callable without parameters.
+        :raise queue.Full: If the queue of the worker is full.
+        """
+        self.submit_all([(key, task)])
+
+    def submit_all(self, tasks, accepted=None):
+        """
+        Enqueues several tasks, all of them or none (i.e. the rules of a notification).
+        :param tasks: List of (key, task), as in submit.
+        :param accepted: Called when there is room for every task, before they are enqueued, i.e. to store the state
+        of the notification only if it is processed.
+        :raise queue.Full: If the queue of some worker has no room for its tasks. Then none is enqueued.
+        """
+        if self.workers <= 0:
+            if accepted is not None:
+                accepted()
+            for _, task in tasks:
+                self._run(task)
+            return
+        self._started.get()
+        by_queue = {}
+        for key, task in tasks:
+            by_queue.setdefault(hash(key) % self.workers, []).append(task)
+        with self._submit_lock:
+            for n, queued in by_queue.items():
+                tasks_queue = self._queues[n]
+                if 0 < tasks_queue.maxsize < tasks_queue.qsize() + len(queued):
+                    self.rejected += len(tasks)
+                    raise queue.Full
+            if accepted is not None:
+                accepted()
+            for n, queued in by_queue.items():
+                for task in queued:
+                    self._queues[n].put_nowait(task)
+
+    def join(self):
+        """
+        Waits until every task enqueued is done.
+        """
+        for tasks in self._queues:
+            tasks.join()
+
+    def stats(self):
+        return {
+            'workers': self.workers, 'queue_size': self.queue_size, 'queued': sum(q.qsize() for q in self._queues),
+            'processed': self.processed, 'rejected': self.rejected, 'errors': self.errors
+        }
@@ -10,11 +10,58 @@ CEP_MONGO_PORT = os.getenv('CEP_MONGO_PORT', '27017')
 CEP_MONGO_DB = os.getenv('CEP_MONGO_DB', 'cepheid')
 CEP_DEFAULT_SERVICE = os.getenv('CEP_DEFAULT_SERVICE', 'orion')
 CEP_DEFAULT_SERVICEPATH = os.getenv('CEP_DEFAULT_SERVICEPATH', '/environment')
+CEP_CB_POOL_SIZE = os.getenv('CEP_CB_POOL_SIZE', '10')  # Connections kept alive to Orion
+CEP_CB_TIMEOUT = os.getenv('CEP_CB_TIMEOUT', '5')  # Seconds
+CEP_CB_RETRIES = os.getenv('CEP_CB_RETRIES', '3')
+CEP_CB_BACKOFF = os.getenv('CEP_CB_BACKOFF', '0.1')  # Seconds, doubled on each retry
+CEP_CACHE_TTL = os.getenv('CEP_CACHE_TTL', '30')  # Seconds a value of an attribute is valid. 0 disables the cache
+CEP_CACHE_SIZE = os.getenv('CEP_CACHE_SIZE', '100000')  # Max. number of attributes cached
+CEP_NOTIFY_WORKERS = os.getenv('CEP_NOTIFY_WORKERS', '4')  # Threads processing notifications. 0 to do it in the request
+CEP_NOTIFY_QUEUE_SIZE = os.getenv('CEP_NOTIFY_QUEUE_SIZE', '1000')  # Notifications waiting per worker
+CEP_BATCH_WINDOW_MS = os.getenv('CEP_BATCH_WINDOW_MS', '20')  # Time a command waits for others. 0 to send it at once
+CEP_BATCH_MAX_ACTIONS = os.getenv('CEP_BATCH_MAX_ACTIONS', '100')  # Max. commands per /v2/op/update
+CEP_SUBSCRIPTION_REFRESH = os.getenv('CEP_SUBSCRIPTION_REFRESH', '10')  # Seconds the rules of a subscription are kept
+CEP_INCREMENTAL_EVAL = os.getenv('CEP_INCREMENTAL_EVAL', 'true')  # Evaluate only the rules whose inputs have changed
+CEP_WINDOW_MAX_SAMPLES = os.getenv('CEP_WINDOW_MAX_SAMPLES', '10000')  # Max. samples of a window function
+CEP_PARSE_CACHE_SIZE = os.getenv('CEP_PARSE_CACHE_SIZE', '1000')  # Max. distinct rules kept parsed
+CEP_BATCH_EVAL_WORKERS = os.getenv('CEP_BATCH_EVAL_WORKERS', '8')  # Rules evaluated at the same time in a batch
+CEP_SCHEDULER_TICK_MS = os.getenv('CEP_SCHEDULER_TICK_MS', '100')  # Periodic rules due within it are run together
+CEP_SCHEDULER_SYNC = os.getenv('CEP_SCHEDULER_SYNC', '30')  # Seconds to look for periodic rules of other workers
+CEP_SCHEDULER_LEASE = os.getenv('CEP_SCHEDULER_LEASE', '15')  # Seconds the worker running the periodic rules is kept
+CEP_BULK_WORKERS = os.getenv('CEP_BULK_WORKERS', '8')  # Rules of a bulk request validated at the same time
+CEP_BULK_MAX_RULES = os.getenv('CEP_BULK_MAX_RULES', '10000')  # Max. rules of a bulk request
+CEP_PLAN_SAMPLES = os.getenv('CEP_PLAN_SAMPLES', '100')  # Evaluations observed to reorder the operands. 0 to not
+CEP_SEQ_MAX_PARTIALS = os.getenv('CEP_SEQ_MAX_PARTIALS', '100')  # Max. sequences being matched at once per SEQ
 CEP_PROVIDER_URL = os.getenv('CEP_PROVIDER_URL', 'http://0.0.0.0:4013')
+# Id of the cached parser tables (written by rply in $XDG_CACHE_HOME/rply). Empty to build them on every start.
+CEP_PARSER_CACHE_ID = os.getenv('CEP_PARSER_CACHE_ID', 'cepheid')
 
 
 default_service = CEP_DEFAULT_SERVICE
 default_servicepath = CEP_DEFAULT_SERVICEPATH
 orion_url = f'http://{CEP_CB_HOST}:{CEP_CB_PORT}'
+orion_pool_size = int(CEP_CB_POOL_SIZE)
+orion_timeout = float(CEP_CB_TIMEOUT)
+orion_retries = int(CEP_CB_RETRIES)
+orion_backoff = float(CEP_CB_BACKOFF)
+cache_ttl = float(CEP_CACHE_TTL)
+cache_size = int(CEP_CACHE_SIZE)
+notify_workers = int(CEP_NOTIFY_WORKERS)
+notify_queue_size = int(CEP_NOTIFY_QUEUE_SIZE)
+batch_window = float(CEP_BATCH_WINDOW_MS) / 1000
+batch_max_actions = int(CEP_BATCH_MAX_ACTIONS)
+subscription_refresh = float(CEP_SUBSCRIPTION_REFRESH)
+incremental_eval = CEP_INCREMENTAL_EVAL.lower() == 'true'
+window_max_samples = int(CEP_WINDOW_MAX_SAMPLES)
+seq_max_partials = int(CEP_SEQ_MAX_PARTIALS)
+plan_samples = int(CEP_PLAN_SAMPLES)
+parse_cache_size = int(CEP_PARSE_CACHE_SIZE)
+bulk_workers = int(CEP_BULK_WORKERS)
+batch_eval_workers = int(CEP_BATCH_EVAL_WORKERS)
+bulk_max_rules = int(CEP_BULK_MAX_RULES)
+scheduler_tick = float(CEP_SCHEDULER_TICK_MS) / 1000
+scheduler_sync = float(CEP_SCHEDULER_SYNC)
+scheduler_lease = float(CEP_SCHEDULER_LEASE)
 iota_url = f'http://{CEP_IOTA_HOST}:{CEP_IOTA_PORT}'
 cepheid_url = CEP_PROVIDER_URL
+parser_cache_id = CEP_PARSER_CACHE_ID or None
@@ -12,8 +12,10 @@ def version():
 
 cep.setup_notifiaciones(app)
 cep.setup_crud(app)
+cep.setup_stats(app)
 # cep.ejecutar_reglas()
 
 if __name__ == '__main__':
+    cep.scheduler.start()  # Served by this process, there are no forked workers
     app.run(host='0.0.0.0', port=4013)
 